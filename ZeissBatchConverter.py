@@ -0,0 +1,220 @@
+#
+# Converts many RIDE_ directories concurrently in a process pool, and records in a
+# JSON manifest which directories were completed, failed or skipped, with their timings
+# and error reasons. Directories whose last conversion completed for the same scan types
+# and output format, and whose images are newer than all of their zip archives, are
+# skipped, so re-running a job after a crash only redoes the failed and missing work.
+# A skip keeps the completed entry and records its time as lastSkipped.
+#
+
+import os, sys, getopt
+import json
+import shutil
+import tempfile
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import ZeissDicomParser
+import ZeissVolumeWriters
+from ZeissMetadataIndex import DicomMetadataIndex
+
+
+def findDataDirectories(rootDirectory):
+    """
+    :return: all RIDE_ directories below rootDirectory, as found by the recursive mode of ZeissDicomParser.
+    """
+    dataDirectories = []
+    for (root, subdirs, files) in os.walk(rootDirectory):
+        for subdir in subdirs:
+            if "RIDE_" in subdir:
+                dataDirectories.append(os.path.join(root, subdir) + "/")
+    return sorted(dataDirectories)
+
+
+def isUpToDate(dataDirectory, scanTypes, outputFormat="nii", manifestEntry=None):
+    """
+    :param manifestEntry: the last manifest entry of dataDirectory, or None.
+    :return: True if the last conversion of dataDirectory completed for the same scanTypes and outputFormat,
+    and its images exist and are newer than every zip archive of dataDirectory.
+    """
+    # A failed conversion may have left some of the images behind, only the manifest tells them apart
+    if manifestEntry is None or manifestEntry.get("status") != "completed" or \
+            sorted(manifestEntry.get("scanTypes", [])) != sorted(scanTypes) or \
+            manifestEntry.get("outputFormat", "nii") != outputFormat:
+        return False
+    zipModificationTimes = [os.path.getmtime(os.path.join(dirpath, filename))
+                            for (dirpath, dirnames, filenames) in os.walk(dataDirectory)
+                            for filename in filenames if filename.endswith(".zip")]
+    if not zipModificationTimes:
+        return False
+    for scanType in scanTypes:
+        outputFilename = os.path.join(dataDirectory, ZeissDicomParser.niftiFilename(scanType, outputFormat))
+        if not os.path.exists(outputFilename) or os.path.getmtime(outputFilename) < max(zipModificationTimes):
+            return False
+    return True
+
+
+def loadManifest(manifestFilename):
+    if not os.path.exists(manifestFilename):
+        return {}
+    with open(manifestFilename) as f:
+        return json.load(f)
+
+
+def saveManifest(manifestFilename, manifest):
+    # Replace the manifest atomically, so that a crash never leaves a truncated manifest
+    tmpFilename = manifestFilename + ".tmp"
+    with open(tmpFilename, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmpFilename, manifestFilename)
+
+
+_scratchDirectory = None
+
+
+def _initializeWorker(scratchRoot):
+    # Every worker gets its own scratch space, so that concurrent conversions never share temporary files
+    global _scratchDirectory
+    _scratchDirectory = tempfile.mkdtemp(prefix="worker_{}_".format(os.getpid()), dir=scratchRoot)
+    tempfile.tempdir = _scratchDirectory
+    os.environ["TMPDIR"] = _scratchDirectory
+
+
+def convertJob(dataDirectory, scanTypes, outputFormat="nii", indexFilename=None):
+    """
+    Converts one directory in a worker process.
+    :param indexFilename: the SQLite metadata index shared by all workers, see ZeissMetadataIndex.
+    :return: a manifest entry with the status, timing and error reason of the conversion.
+    """
+    start = time.time()
+    entry = {"scanTypes": scanTypes, "outputFormat": outputFormat, "started": start, "worker": os.getpid()}
+    index = None
+    try:
+        if indexFilename is not None:
+            index = DicomMetadataIndex(indexFilename)
+        niftis = ZeissDicomParser.convertDirectory(scanTypes, dataDirectory, outputFormat=outputFormat, index=index)
+        for nifti in niftis.values():
+            ZeissVolumeWriters.closeVolume(nifti)
+        entry["status"] = "completed"
+        entry["outputs"] = [os.path.join(dataDirectory, ZeissDicomParser.niftiFilename(scanType, outputFormat))
+                            for scanType in scanTypes]
+    except Exception as e:
+        entry["status"] = "failed"
+        entry["error"] = type(e).__name__ + ": " + str(e)
+        entry["traceback"] = traceback.format_exc()
+    finally:
+        if index is not None:
+            index.close()
+    entry["seconds"] = time.time() - start
+    return entry
+
+
+def runBatch(rootDirectory, scanTypes, manifestFilename, numWorkers=None, force=False, outputFormat="nii",
+             indexFilename=None):
+    """
+    Converts every RIDE_ directory below rootDirectory that is not up to date.
+    :param rootDirectory: the directory that contains the RIDE_ directories.
+    :param scanTypes: a list of "Macular Cube", "Angiography 3x3", or "Angiography 8x8".
+    :param manifestFilename: the JSON manifest, updated after every directory.
+    :param numWorkers: the number of worker processes, defaults to the number of cpus.
+    :param force: converts directories even if they are up to date.
+    :param outputFormat: the format of the images, see ZeissDicomParser.niftiFilename.
+    :param indexFilename: the SQLite metadata index caching the DICOM headers, or None.
+    :return: the manifest, a dictionary with the entry of every directory, and the list of the
+    directories skipped by this run.
+    """
+    manifest = loadManifest(manifestFilename)
+
+    dataDirectories = findDataDirectories(rootDirectory)
+    pendingDirectories = []
+    skippedDirectories = []
+    started = time.time()
+    for dataDirectory in dataDirectories:
+        if force or not isUpToDate(dataDirectory, scanTypes, outputFormat, manifest.get(dataDirectory)):
+            pendingDirectories.append(dataDirectory)
+        else:
+            manifest[dataDirectory]["lastSkipped"] = started
+            skippedDirectories.append(dataDirectory)
+    saveManifest(manifestFilename, manifest)
+    print("{} directories to convert, {} up to date.".format(len(pendingDirectories), len(skippedDirectories)))
+
+    scratchRoot = tempfile.mkdtemp(prefix="zeissBatch_")
+    try:
+        with ProcessPoolExecutor(max_workers=numWorkers, initializer=_initializeWorker,
+                                 initargs=(scratchRoot,)) as executor:
+            futures = {executor.submit(convertJob, dataDirectory, scanTypes, outputFormat, indexFilename): dataDirectory
+                       for dataDirectory in pendingDirectories}
+            for future in as_completed(futures):
+                dataDirectory = futures[future]
+                try:
+                    manifest[dataDirectory] = future.result()
+                except Exception as e:
+                    # The worker itself died, e.g. killed for running out of memory
+                    manifest[dataDirectory] = {"status": "failed", "error": type(e).__name__ + ": " + str(e),
+                                               "scanTypes": scanTypes}
+                saveManifest(manifestFilename, manifest)
+                print(dataDirectory + ": " + manifest[dataDirectory]["status"])
+    finally:
+        shutil.rmtree(scratchRoot, ignore_errors=True)
+
+    return manifest, skippedDirectories
+
+
+def help():
+    print("ZeissBatchConverter.py -i <rootdirectory> -t <scantype|all> [-m <manifest.json>] [-w <workers>] [-F] "
+          "[-f <" + "|".join(ZeissVolumeWriters.OUTPUT_FORMATS) + ">] [-c <index.db>]")
+
+
+if __name__ == "__main__":
+
+    rootDirectory = None
+    scanType = "all"
+    manifestFilename = None
+    numWorkers = None
+    force = False
+    outputFormat = "nii"
+    indexFilename = None
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hi:t:m:w:Ff:c:",
+                                   ["inputdirectory=", "scantype=", "manifest=", "workers=", "force", "format=",
+                                    "index="])
+    except getopt.GetoptError:
+        help()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            help()
+            sys.exit()
+        elif opt in ("-i", "--inputdirectory"):
+            rootDirectory = arg
+        elif opt in ("-t", "--scantype"):
+            scanType = arg
+        elif opt in ("-m", "--manifest"):
+            manifestFilename = arg
+        elif opt in ("-w", "--workers"):
+            numWorkers = int(arg)
+        elif opt in ("-F", "--force"):
+            force = True
+        elif opt in ("-f", "--format"):
+            outputFormat = arg
+        elif opt in ("-c", "--index"):
+            indexFilename = arg
+
+    if rootDirectory is None or outputFormat not in ZeissVolumeWriters.OUTPUT_FORMATS:
+        help()
+        sys.exit(2)
+
+    if scanType == "All" or scanType == "all":
+        scanTypes = ZeissDicomParser.SCAN_TYPES
+    else:
+        scanTypes = [scanType]
+
+    if manifestFilename is None:
+        manifestFilename = os.path.join(rootDirectory, "conversionManifest.json")
+
+    manifest, skippedDirectories = runBatch(rootDirectory, scanTypes, manifestFilename, numWorkers, force,
+                                            outputFormat, indexFilename)
+    statuses = [entry["status"] for entry in manifest.values()]
+    print("Completed {}, failed {}, skipped {}. Manifest saved at {}".format(
+        statuses.count("completed"), statuses.count("failed"), len(skippedDirectories), manifestFilename))
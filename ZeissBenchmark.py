@@ -0,0 +1,224 @@
+#
+# Benchmark of the Zeiss DICOM to NIfTI conversion on synthetic exports (see
+# ZeissSyntheticExport), so that no patient data is needed. For every export size,
+# retrieveDicomFiles, aggregateDicomProperties and createNifty are timed separately,
+# with the bytes they read and wrote and their peak memory, and the results are written
+# to JSON to track regressions across changes.
+#
+
+import os, sys, getopt
+import importlib
+import json
+import platform
+import resource
+import shutil
+import tempfile
+import time
+import zipfile
+
+import ZeissDicomParser
+from ZeissSyntheticExport import EXPORT_SIZES, SCAN_PROTOCOLS, generateSyntheticExport
+
+
+def readIoCounters():
+    """
+    :return: the bytes read and written by the read and write calls of this process, all threads
+    included, or None where /proc/self/io is not available. Reads through a memory map, as of
+    uncompressed zip members, are not counted.
+    """
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def resetPeakMemory():
+    """
+    Resets the resident set size high-water mark of this process, where Linux allows it.
+    :return: True if the high-water mark was reset.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def readPeakMemory():
+    """
+    :return: the resident set size high-water mark of this process in bytes.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # Not Linux, the high-water mark since the start of the process (kilobytes on Linux, bytes on macOS)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak * 1024 if sys.platform.startswith("linux") else peak
+
+
+def warmUpImports(outputFormat="nii"):
+    """
+    Imports the modules that ZeissDicomParser and ZeissVolumeWriters import lazily, so that their
+    import time is not measured as part of the first stage that uses them.
+    """
+    for module in ["numpy", "pydicom", "nibabel"] + {"zarr": ["zarr"], "hdf5": ["h5py"]}.get(outputFormat, []):
+        importlib.import_module(module)
+
+
+def measure(results, name, function, *args, **kwargs):
+    """
+    Runs function and records in results[name] its wall time in seconds, the bytes it read and
+    wrote, and the peak resident set size of the process while it ran.
+    """
+    peakReset = resetPeakMemory()
+    ioBefore = readIoCounters()
+    start = time.perf_counter()
+    value = function(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    ioAfter = readIoCounters()
+
+    results[name] = {"seconds": seconds, "peakMemoryBytes": readPeakMemory(), "peakMemoryOfStage": peakReset}
+    if ioBefore is not None and ioAfter is not None:
+        results[name]["bytesRead"] = ioAfter[0] - ioBefore[0]
+        results[name]["bytesWritten"] = ioAfter[1] - ioBefore[1]
+    return value
+
+
+def outputSize(outputFilename):
+    """
+    :return: the size in bytes of an output file, or of all files of a Zarr directory.
+    """
+    if not os.path.isdir(outputFilename):
+        return os.path.getsize(outputFilename)
+    return sum(os.path.getsize(os.path.join(dirpath, filename))
+               for dirpath, dirnames, filenames in os.walk(outputFilename) for filename in filenames)
+
+
+def benchmarkExport(dataDirectory, scanTypes, expected, numWorkers=None, outputFormat="nii"):
+    """
+    Times the conversion stages of every scan type of one export.
+    :param expected: the properties of every scan type, as returned by generateSyntheticExport.
+    :return: a dictionary with the measurements of every scan type, and whether the converted
+    properties and volume shape match those of the export.
+    """
+    results = {}
+    for scanType in scanTypes:
+        stages = {}
+        tmpDirectoriesCreated, dicomFilenames = measure(stages, "retrieveDicomFiles",
+                                                        ZeissDicomParser.retrieveDicomFiles, scanType, dataDirectory,
+                                                        numWorkers)
+        properties = measure(stages, "aggregateDicomProperties", ZeissDicomParser.aggregateDicomProperties,
+                             scanType, dicomFilenames)
+        image, tmpDirectoriesCreated = measure(stages, "createNifty", ZeissDicomParser.createNifty, scanType,
+                                               dataDirectory, properties, outputFormat=outputFormat,
+                                               numThreads=numWorkers)
+
+        stages["createNifty"]["outputBytes"] = outputSize(
+            os.path.join(dataDirectory, ZeissDicomParser.niftiFilename(scanType, outputFormat)))
+        stages["dicomFiles"] = len(dicomFilenames)
+
+        expectedShape = (expected[scanType]["imageWidthInPixels"], expected[scanType]["imageDepthInPixels"],
+                         expected[scanType]["numSlices"])
+        # bitDepth is not a property of the export
+        stages["correct"] = tuple(image.shape) == expectedShape and \
+            all(abs(value - expected[scanType][name]) < 1e-9
+                for name, value in zip(ZeissDicomParser.PROPERTY_NAMES[:-1], properties))
+        ZeissDicomParser.closeVolume(image)
+        results[scanType] = stages
+    return results
+
+
+def runBenchmark(sizes=("small", "medium"), workDirectory=None, numWorkers=None, outputFormat="nii",
+                 compression=zipfile.ZIP_DEFLATED):
+    """
+    Generates one synthetic export of every size and benchmarks its conversion.
+    :param sizes: the names of the export sizes, see ZeissSyntheticExport.EXPORT_SIZES.
+    :param compression: the compression of the zip archives, zipfile.ZIP_DEFLATED or zipfile.ZIP_STORED.
+    :return: a JSON-serializable dictionary of the results.
+    """
+    import numpy as np
+    import pydicom
+
+    warmUpImports(outputFormat)
+
+    removeWorkDirectory = workDirectory is None
+    if workDirectory is None:
+        workDirectory = tempfile.mkdtemp(prefix="zeiss_benchmark_")
+    scanTypes = list(SCAN_PROTOCOLS)
+
+    results = {
+        "config": {"sizes": list(sizes), "outputFormat": outputFormat, "numWorkers": numWorkers,
+                   "compression": "stored" if compression == zipfile.ZIP_STORED else "deflated"},
+        "environment": {"python": platform.python_version(), "numpy": np.__version__, "pydicom": pydicom.__version__,
+                        "platform": platform.platform(), "cpus": os.cpu_count()},
+    }
+    try:
+        for size in sizes:
+            dataDirectory = os.path.join(workDirectory, "RIDE_" + size) + "/"
+            sizeResults = {"exportSize": dict(zip(["numDicomFiles", "imageWidthInPixels", "imageDepthInPixels",
+                                                   "numAngiographySlices"], EXPORT_SIZES[size]))}
+            start = time.perf_counter()
+            expected = generateSyntheticExport(dataDirectory, scanTypes, *EXPORT_SIZES[size], compression=compression)
+            sizeResults["generateSeconds"] = time.perf_counter() - start
+            sizeResults["archiveBytes"] = {filename: os.path.getsize(os.path.join(dataDirectory, filename))
+                                           for filename in sorted(os.listdir(dataDirectory))}
+            sizeResults["scanTypes"] = benchmarkExport(dataDirectory, scanTypes, expected, numWorkers, outputFormat)
+            results[size] = sizeResults
+    finally:
+        if removeWorkDirectory:
+            shutil.rmtree(workDirectory, ignore_errors=True)
+    return results
+
+
+def help():
+    print("ZeissBenchmark.py [-s <" + ",".join(EXPORT_SIZES) + ">] [-d <workdirectory>] [-o <results.json>] "
+          "[-w <workers>] [-f <outputformat>] [-u]")
+
+
+if __name__ == "__main__":
+
+    sizes = ["small", "medium"]
+    workDirectory = None
+    outputFile = "zeiss_benchmark_results.json"
+    numWorkers = None
+    outputFormat = "nii"
+    compression = zipfile.ZIP_DEFLATED
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hs:d:o:w:f:u",
+                                   ["sizes=", "workdirectory=", "output=", "workers=", "format=", "uncompressed"])
+    except getopt.GetoptError:
+        help()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            help()
+            sys.exit()
+        elif opt in ("-s", "--sizes"):
+            sizes = arg.split(",")
+        elif opt in ("-d", "--workdirectory"):
+            workDirectory = os.path.abspath(arg)
+        elif opt in ("-o", "--output"):
+            outputFile = arg
+        elif opt in ("-w", "--workers"):
+            numWorkers = int(arg)
+        elif opt in ("-f", "--format"):
+            outputFormat = arg
+        elif opt in ("-u", "--uncompressed"):
+            compression = zipfile.ZIP_STORED
+
+    if any(size not in EXPORT_SIZES for size in sizes) or outputFormat not in ZeissDicomParser.OUTPUT_FORMATS:
+        help()
+        sys.exit(2)
+
+    results = runBenchmark(sizes, workDirectory, numWorkers, outputFormat, compression)
+    with open(outputFile, "w") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+    print("Benchmark results saved at " + outputFile)
@@ -0,0 +1,113 @@
+#
+# Python API of the conversion of the exports of the Zeiss Cirrus OCT machine. A
+# ZeissConverter is created once and called in-process for any number of exports: it
+# returns the volumes as numpy arrays with their affine, or writes them to files, and
+# raises the ZeissExportError subclasses of ZeissDicomParser for exports that cannot be
+# converted. pydicom, numpy and nibabel are only imported by the first conversion.
+#
+# Parser messages are logged to the "ZeissDicomParser" logger.
+#
+
+from collections import namedtuple
+
+import ZeissDicomParser
+from ZeissDicomParser import SCAN_TYPES, ZeissExportError, UnknownScanTypeError, MissingDataError, \
+    AmbiguousDataError, InvalidDataError
+from ZeissMetadataIndex import DicomMetadataIndex
+
+__all__ = ["ZeissConverter", "ScanVolume", "SCAN_TYPES", "ZeissExportError", "UnknownScanTypeError",
+           "MissingDataError", "AmbiguousDataError", "InvalidDataError"]
+
+# volume is a uint8 array of imageWidthInPixels x imageDepthInPixels x numSlices voxels, affine
+# maps them to mm, and properties are the aggregated DICOM properties (see aggregateDicomProperties)
+ScanVolume = namedtuple("ScanVolume", ["scanType", "volume", "affine", "properties"])
+
+
+class ZeissConverter:
+    """
+    Converts the scans of Zeiss export directories.
+
+        with ZeissConverter(["Angiography 3x3"], indexFilename="index.db") as converter:
+            for scan in converter.iterateVolumes(dataDirectory):
+                process(scan.volume, scan.affine)
+    """
+    def __init__(self, scanTypes=SCAN_TYPES, numWorkers=None, indexFilename=None, flipInAffine=False):
+        """
+        :param scanTypes: a list of "Macular Cube", "Angiography 3x3", or "Angiography 8x8".
+        :param numWorkers: the number of threads reading DICOM headers, and compressing "nii.gz" output.
+        :param indexFilename: a SQLite metadata index caching the DICOM headers across exports, see
+        ZeissMetadataIndex, or None.
+        :param flipInAffine: see ZeissDicomParser.writeNiftyStreaming.
+        :raise UnknownScanTypeError: for scan types other than those of SCAN_TYPES.
+        """
+        for scanType in scanTypes:
+            if scanType not in SCAN_TYPES:
+                raise UnknownScanTypeError("Unknown scan type '" + scanType + "', expected one of " +
+                                           ", ".join(SCAN_TYPES) + ".")
+        self.scanTypes = list(scanTypes)
+        self.numWorkers = numWorkers
+        self.flipInAffine = flipInAffine
+        self.index = DicomMetadataIndex(indexFilename) if indexFilename is not None else None
+
+    def readProperties(self, dataDirectory):
+        """
+        Reads the DICOM headers of an export once for all scan types.
+        :return: a dictionary with the aggregated properties of every scan type, see
+        ZeissDicomParser.aggregateDicomProperties.
+        :raise MissingDataError: if a scan type has no valid DICOM file.
+        """
+        tmpDirectoriesCreated, dicomFilesPerScanType = ZeissDicomParser.retrieveAllDicomFiles(
+            self.scanTypes, dataDirectory, self.numWorkers, self.index)
+        return {scanType: ZeissDicomParser.aggregateDicomProperties(scanType, dicomFilesPerScanType[scanType])
+                for scanType in self.scanTypes}
+
+    def iterateVolumes(self, dataDirectory):
+        """
+        Reads the volumes of all scan types of an export, one at a time, so that only one volume
+        is held in memory.
+        :return: an iterator of ScanVolume.
+        :raise ZeissExportError: if the DICOM files or the raw data of a scan type are missing, ambiguous or
+        invalid.
+        """
+        propertiesPerScanType = self.readProperties(dataDirectory)
+        rawDataMembers = ZeissDicomParser.listRawDataMembers(dataDirectory)
+        for scanType in self.scanTypes:
+            properties = propertiesPerScanType[scanType]
+            imgFilename = ZeissDicomParser.findRawDataMember(scanType, rawDataMembers)
+            volume, affine = ZeissDicomParser.readVolume(imgFilename, properties[0], properties[1], properties[2],
+                                                         properties[3], properties[4], self.flipInAffine)
+            yield ScanVolume(scanType, volume, affine, properties)
+
+    def loadVolumes(self, dataDirectory):
+        """
+        :return: a dictionary with the ScanVolume of every scan type of an export.
+        """
+        return {scan.scanType: scan for scan in self.iterateVolumes(dataDirectory)}
+
+    def convert(self, dataDirectory, outputFormat="nii"):
+        """
+        Writes the volumes of all scan types of an export next to it, see ZeissDicomParser.createNifty.
+        :param outputFormat: one of ZeissVolumeWriters.OUTPUT_FORMATS.
+        :return: a dictionary with the output filename of every scan type.
+        """
+        propertiesPerScanType = self.readProperties(dataDirectory)
+        rawDataMembers = ZeissDicomParser.listRawDataMembers(dataDirectory)
+        outputFilenames = {}
+        for scanType in self.scanTypes:
+            image, tmpDirectoriesCreated = ZeissDicomParser.createNifty(
+                scanType, dataDirectory, propertiesPerScanType[scanType], rawDataMembers, self.flipInAffine,
+                outputFormat, self.numWorkers)
+            ZeissDicomParser.closeVolume(image)
+            outputFilenames[scanType] = dataDirectory + "/" + ZeissDicomParser.niftiFilename(scanType, outputFormat)
+        return outputFilenames
+
+    def close(self):
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
@@ -10,27 +10,73 @@
 # 2018.03.28
 #
 
-import pydicom
-from pydicom import valuerep
+# pydicom and numpy are imported in the functions that use them, so that importing this module
+# and running -h stay cheap.
 import re
-import zipfile
+import itertools
+import logging
 from os import walk
 import os, sys, getopt
 import shutil
-import numpy as np
-import nibabel
+from concurrent.futures import ThreadPoolExecutor
+from ZeissZipReader import ZipMember, listZipMembers
+from ZeissVolumeWriters import OUTPUT_FORMATS, closeVolume, createVolumeWriter, outputExtension
+from ZeissMetadataIndex import DicomMetadataIndex
 
+SCAN_TYPES = ["Macular Cube", "Angiography 8x8", "Angiography 3x3"]
 
-def createNifty(scanType, dataDirectory, properties):
+logger = logging.getLogger("ZeissDicomParser")
+
+
+class ZeissExportError(Exception):
     """
-    Parses the dataDirectory to identify the IMGExport folder where the raw data
-    are located, and identifies the appropriate file according to scanType. Then,
-    using the properties provided, creates a nifty image and saves it.
-    :param nifti: the created nifti image.
-    :param directoryToRemove: the temporary directory to be removed.
+    Base class of the errors raised for exports that cannot be converted.
+    """
+
+
+class UnknownScanTypeError(ZeissExportError, ValueError):
+    pass
+
+
+class MissingDataError(ZeissExportError):
     """
-    tmpDir = "/tmp/"  # os.getcwd()
+    The raw data or the DICOM files of a scan are missing, or none of the DICOM files is valid.
+    """
+
+
+class AmbiguousDataError(ZeissExportError):
+    """
+    More than one raw data zip file, or raw data file of a scan type, was found.
+    """
+
+
+class InvalidDataError(ZeissExportError, ValueError):
+    """
+    A raw data file or a DICOM file is inconsistent, or lacks a tag the conversion needs.
+    """
+
 
+def niftiFilename(scanType, outputFormat="nii"):
+    """
+    :param scanType: can be "Macular Cube", "Angiography 3x3", or "Angiography 8x8".
+    :param outputFormat: one of ZeissVolumeWriters.OUTPUT_FORMATS, "nii", "nii.gz", "zarr" or "hdf5".
+    :return: the name of the image created for scanType in the data directory.
+    """
+    if scanType in "Macular Cube":
+        return "macularCube" + outputExtension(outputFormat)
+    if scanType in "Angiography 3x3":
+        return "angiography3x3" + outputExtension(outputFormat)
+    if scanType in "Angiography 8x8":
+        return "angiography8x8" + outputExtension(outputFormat)
+
+
+def listRawDataMembers(dataDirectory):
+    """
+    Parses the dataDirectory to identify the IMGExport zip file where the raw data
+    are located, and lists its members once for all scan types.
+    :param dataDirectory: the root-level directory containing the IMG data.
+    :return: a list of ZipMember.
+    """
     # Retrieve list of zip files that contain IMG data in root-directory
     zipFilenameList = []
     zipPathList = []
@@ -41,51 +87,41 @@ def createNifty(scanType, dataDirectory, properties):
                 zipPathList.append(dirpath)
 
     if len(zipFilenameList) > 1:
-        print("Error - More than one raw data zipfile detected.")
-        exit(1)
+        raise AmbiguousDataError("More than one raw data zipfile detected in " + dataDirectory + ".")
+    if not zipFilenameList:
+        raise MissingDataError("No raw data zipfile detected in " + dataDirectory + ".")
 
     zipFilename = zipFilenameList[0]
     zipPath = zipPathList[0]
 
-    # Unzip the IMG folder
-    directoryToCreate = tmpDir + zipFilename[:-4]
-    if not os.path.exists(directoryToCreate):
-        os.makedirs(directoryToCreate)
+    return listZipMembers(os.path.join(zipPath, zipFilename))
 
-    # Grab the entire path of the zip file
-    zipFileObject = zipfile.ZipFile(zipPath + zipFilename)
 
-    # Extract it in the newly generated folder
-    zipFileObject.extractall(directoryToCreate)
-
-    # Go through all the folders and retrieve all relevant .raw files
-    imgFilenameList = []
-    for (dirpath, dirnames, filenames) in walk(directoryToCreate):
-        for filename in filenames:
-            if ( ("cube_raw" in filename) and (scanType in filename) and (scanType in "Macular Cube") ) or \
-                ( ("FlowCube_raw" in filename) and (scanType in filename) and ("Angiography 8x8" in scanType) ) or \
-                    (("FlowCube_raw" in filename) and (scanType in filename) and ("Angiography 3x3" in scanType)):
-                imgFilenameList.append(dirpath + "/" + filename)
-    # print(imgFilenameList)
-
-    if len(imgFilenameList) > 1:
-        print("Error - More than one raw datafile detected.")
-        exit(1)
+def createNifty(scanType, dataDirectory, properties, rawDataMembers=None, flipInAffine=False, outputFormat="nii",
+                numThreads=None):
+    """
+    Parses the dataDirectory to identify the IMGExport folder where the raw data
+    are located, and identifies the appropriate file according to scanType. Then,
+    using the properties provided, creates a nifty image and saves it.
+    The raw data are read straight from the zip archive, without extracting it.
+    :param rawDataMembers: the members of the IMGExport zip file (see listRawDataMembers),
+    listed here if not given.
+    :param flipInAffine: see writeNiftyStreaming.
+    :raise MissingDataError, AmbiguousDataError: if not exactly one raw data file belongs to scanType.
+    :param outputFormat: the format of the image, see niftiFilename.
+    :param numThreads: the number of compression threads of "nii.gz" output.
+    :param nifti: the created image, opened lazily. The caller closes it with closeVolume, see
+    ZeissVolumeWriters.createVolumeWriter.
+    :param directoryToRemove: the temporary directories to be removed, none are created anymore.
+    """
+    if rawDataMembers is None:
+        rawDataMembers = listRawDataMembers(dataDirectory)
 
-    imgFilename = imgFilenameList[0]
+    imgFilename = findRawDataMember(scanType, rawDataMembers)
 
     # Create fully qualified name to save the image
-    if scanType in "Macular Cube":
-        outputFileFullyQualifiedName = "macularCube.nii"
-    if scanType in "Angiography 3x3":
-        outputFileFullyQualifiedName = "angiography3x3.nii"
-    if scanType in "Angiography 8x8":
-        outputFileFullyQualifiedName = "angiography8x8.nii"
-
     outputFileFullyQualifiedName  = os.path.join(
-        dataDirectory + "/" + outputFileFullyQualifiedName)
-
-    data = np.fromfile(imgFilename, dtype='uint8')
+        dataDirectory + "/" + niftiFilename(scanType, outputFormat))
 
     sliceThicknessInMM = properties[0]
     pixelWidthInMM = properties[1]
@@ -94,47 +130,246 @@ def createNifty(scanType, dataDirectory, properties):
     imageDepthInPixels = properties[4]
     bitDepth = properties[5]
 
+    nifti = writeNiftyStreaming(imgFilename, outputFileFullyQualifiedName, sliceThicknessInMM, pixelWidthInMM,
+                                pixelDepthInMM, imageWidthInPixels, imageDepthInPixels, flipInAffine, numThreads)
+    logger.info("Image saved at " + outputFileFullyQualifiedName)
+
+    return nifti, []
+
+
+def findRawDataMember(scanType, rawDataMembers):
+    """
+    :param rawDataMembers: the members of the IMGExport zip file, see listRawDataMembers.
+    :return: the member with the raw data of scanType.
+    :raise MissingDataError, AmbiguousDataError: if not exactly one raw data file belongs to scanType.
+    """
+    # Go through the members of the zip file and retrieve all relevant .raw files
+    imgFilenameList = []
+    for member in rawDataMembers:
+        filename = os.path.basename(member.name)
+        if ( ("cube_raw" in filename) and (scanType in filename) and (scanType in "Macular Cube") ) or \
+            ( ("FlowCube_raw" in filename) and (scanType in filename) and ("Angiography 8x8" in scanType) ) or \
+                (("FlowCube_raw" in filename) and (scanType in filename) and ("Angiography 3x3" in scanType)):
+            imgFilenameList.append(member)
+    # print(imgFilenameList)
+
+    if len(imgFilenameList) > 1:
+        raise AmbiguousDataError("More than one raw datafile detected for " + scanType + ".")
+    if not imgFilenameList:
+        raise MissingDataError("No raw datafile detected for " + scanType + ".")
+
+    return imgFilenameList[0]
+
+
+def rawDataSize(imgFilename):
+    if isinstance(imgFilename, ZipMember):
+        return imgFilename.size
+    return os.path.getsize(imgFilename)
+
+
+def iterateRawSlices(imgFilename, sliceSize):
+    """
+    Reads a raw cube slice by slice, without ever holding the whole cube in memory.
+    :param imgFilename: the path of the raw file, or its ZipMember.
+    :param sliceSize: the number of bytes of a slice.
+    :return: an iterator of bytes-like slices. Slices of raw files and of uncompressed
+    zip members are views into a memory map.
+    """
+    if isinstance(imgFilename, ZipMember):
+        return imgFilename.iterateChunks(sliceSize)
+    import numpy as np
+
+    data = np.memmap(imgFilename, dtype='uint8', mode='r')
+    return (data[offset:offset + sliceSize] for offset in range(0, len(data), sliceSize))
+
+
+def writeNiftyStreaming(imgFilename, outputFilename, sliceThicknessInMM, pixelWidthInMM, pixelDepthInMM,
+                        imageWidthInPixels, imageDepthInPixels, flipInAffine=False, numThreads=None):
+    """
+    Converts a raw cube to a nifti image slice by slice, so that memory use is bounded by one
+    slice and independent of the volume size.
+    The raw cube holds numSlices x imageDepthInPixels x imageWidthInPixels voxels in C order,
+    the nifti image holds imageWidthInPixels x imageDepthInPixels x numSlices voxels in Fortran
+    order, with the depth axis flipped. The permutation therefore maps every raw slice to one
+    contiguous slice of the nifti image, with its rows in reverse order.
+    The extension of outputFilename selects the format, .nii, .nii.gz, .zarr or .h5 (see
+    ZeissVolumeWriters). Zarr and HDF5 volumes have the same axes, chunked per slice.
+    :param flipInAffine: expresses the flip of the depth axis in the sform instead of reversing
+    the rows, so that the raw bytes are copied unchanged. The voxel array then differs from the
+    default conversion, while the voxels map to the same positions in mm.
+    :param numThreads: the number of compression threads of .nii.gz output.
+    :return: the saved image, opened lazily from outputFilename.
+    """
+    numSlices = countRawSlices(imgFilename, imageWidthInPixels, imageDepthInPixels)
+    sform = volumeAffine(sliceThicknessInMM, pixelWidthInMM, pixelDepthInMM, imageDepthInPixels, flipInAffine)
+
+    writer = createVolumeWriter(outputFilename, (imageWidthInPixels, imageDepthInPixels, numSlices), sform,
+                                numThreads)
+    try:
+        for sliceIndex, volumeSlice in enumerate(iterateVolumeSlices(imgFilename, imageWidthInPixels,
+                                                                     imageDepthInPixels, flipInAffine)):
+            writer.writeSlice(sliceIndex, volumeSlice)
+        return writer.close()
+    except BaseException:
+        # No partial volume is left under the name of a complete one
+        writer.abort()
+        raise
+
+
+def countRawSlices(imgFilename, imageWidthInPixels, imageDepthInPixels):
+    """
+    :return: the number of slices of a raw cube.
+    :raise InvalidDataError: if the raw data is not a whole number of slices.
+    """
+    sliceSize = imageDepthInPixels * imageWidthInPixels
+
 # TODO: Double check that this matches the retrieved number of slices
 # TODO: The above was verified manually - CB.
-    numSlices = int(len(data) / imageDepthInPixels / imageWidthInPixels)
-    data = np.reshape(data, (numSlices, imageDepthInPixels, imageWidthInPixels))
-    data = np.moveaxis(data, 0, -1)
-    data = np.transpose(data, (1, 0, 2))
-    data = np.flip(data, 1)
-
-    # print(np.shape(data))
-    niHdr = nibabel.Nifti1Header()
-    niHdr.set_data_shape(data.shape)
-    niHdr.set_data_dtype(np.uint8)
-    niHdr.set_xyzt_units('mm', 'sec')
+    numSlices = int(rawDataSize(imgFilename) / imageDepthInPixels / imageWidthInPixels)
+    if numSlices * sliceSize != rawDataSize(imgFilename):
+        raise InvalidDataError("Raw data of " + str(rawDataSize(imgFilename)) + " bytes is not a whole number of " +
+                         str(imageDepthInPixels) + "x" + str(imageWidthInPixels) + " slices.")
+    return numSlices
+
+
+def volumeAffine(sliceThicknessInMM, pixelWidthInMM, pixelDepthInMM, imageDepthInPixels, flipInAffine=False):
+    """
+    :param flipInAffine: see writeNiftyStreaming.
+    :return: the 4x4 affine that maps the voxels of the volume to mm.
+    """
+    import numpy as np
 
     sform = np.diag([pixelWidthInMM, pixelDepthInMM, sliceThicknessInMM, 1.0])
-    nifti = nibabel.Nifti1Image(data, sform, niHdr)
+    if flipInAffine:
+        sform[1, 1] = -pixelDepthInMM
+        sform[1, 3] = (imageDepthInPixels - 1) * pixelDepthInMM
+    return sform
+
+
+def iterateVolumeSlices(imgFilename, imageWidthInPixels, imageDepthInPixels, flipInAffine=False):
+    """
+    Reads a raw cube slice by slice, in the orientation of the nifti image (see writeNiftyStreaming).
+    :return: an iterator of imageDepthInPixels x imageWidthInPixels uint8 arrays, holding the voxels
+    (x, y) of a slice of the volume at [y, x].
+    """
+    import numpy as np
 
-    nibabel.save(nifti, outputFileFullyQualifiedName)
-    print("Nifti image saved at " + outputFileFullyQualifiedName)
+    numSlices = countRawSlices(imgFilename, imageWidthInPixels, imageDepthInPixels)
+    rawSlices = itertools.islice(iterateRawSlices(imgFilename, imageDepthInPixels * imageWidthInPixels), numSlices)
+    for rawSlice in rawSlices:
+        rawSlice = np.frombuffer(rawSlice, dtype='uint8').reshape(imageDepthInPixels, imageWidthInPixels)
+        yield rawSlice if flipInAffine else rawSlice[::-1]
 
-    return nifti, directoryToCreate
 
+def readVolume(imgFilename, sliceThicknessInMM, pixelWidthInMM, pixelDepthInMM, imageWidthInPixels,
+               imageDepthInPixels, flipInAffine=False):
+    """
+    Reads a raw cube into memory, with the voxel array and the affine of the nifti image that
+    writeNiftyStreaming would create.
+    :return: the imageWidthInPixels x imageDepthInPixels x numSlices uint8 volume, in Fortran order,
+    and its affine.
+    """
+    import numpy as np
+
+    numSlices = countRawSlices(imgFilename, imageWidthInPixels, imageDepthInPixels)
+    volume = np.empty((imageWidthInPixels, imageDepthInPixels, numSlices), dtype=np.uint8, order='F')
+    for sliceIndex, volumeSlice in enumerate(iterateVolumeSlices(imgFilename, imageWidthInPixels,
+                                                                 imageDepthInPixels, flipInAffine)):
+        volume[:, :, sliceIndex] = volumeSlice.T
+    return volume, volumeAffine(sliceThicknessInMM, pixelWidthInMM, pixelDepthInMM, imageDepthInPixels,
+                                flipInAffine)
 
-def retrieveDicomFiles(scanType, dataDirectory):
+
+def readDicomMetadata(scanType, dicomFilename, keepUnmatched=False):
+    """
+    Reads the header of a DICOM file, stopping before its pixel data, and extracts the tags of
+    the properties of the scan from it. Every file is read once, the record is passed on to
+    aggregateDicomProperties, which validates the tags of all files of a scan type at once.
+    :param scanType: can be "Macular Cube", "Angiography 3x3", or "Angiography 8x8", or a list of them.
+    :param dicomFilename: the path to the dicom file to be read, or its ZipMember.
+    :param keepUnmatched: returns a record without scan type and properties for files that do
+    not belong to any scanType, instead of None.
+    :return: a metadata record with the filename, the scan type, the CodeMeaning, the number of
+    frames, the extracted tags (see extractDicomTags) and the parsed properties, None until they
+    are parsed (see parsePropertyRecords), or None if the file does not belong to any scanType.
+    :raise InvalidDataError: if the file has no CodeMeaning of the performed protocol.
+    """
+    import pydicom
+
+    scanTypes = [scanType] if isinstance(scanType, str) else scanType
+
+    if isinstance(dicomFilename, ZipMember):
+        # Only the compressed bytes up to the pixel data are read from the archive
+        with dicomFilename.open() as dicomFile:
+            dcm = pydicom.dcmread(dicomFile, stop_before_pixels=True)
+    else:
+        dcm = pydicom.dcmread(dicomFilename, stop_before_pixels=True)
+    try:
+        # PerformedProtocolCodeSequence
+        codeMeaning = dcm[0x40, 0x260][0][0x08, 0x104].value
+    except (KeyError, IndexError):
+        raise InvalidDataError("No CodeMeaning of the performed protocol in " + str(dicomFilename) + ".")
+    try:
+        numberOfFrames = int(dcm.NumberOfFrames)
+    except (AttributeError, TypeError, ValueError):
+        numberOfFrames = None
+    for scanType in scanTypes:
+        if scanType in codeMeaning:
+            return {"filename": dicomFilename,
+                    "scanType": scanType,
+                    "codeMeaning": codeMeaning,
+                    "numberOfFrames": numberOfFrames,
+                    "tags": extractDicomTags(dcm),
+                    "properties": None}
+
+    if keepUnmatched:
+        return {"filename": dicomFilename,
+                "scanType": None,
+                "codeMeaning": codeMeaning,
+                "numberOfFrames": numberOfFrames,
+                "tags": None,
+                "properties": None}
+    return None
+
+
+def retrieveDicomFiles(scanType, dataDirectory, numWorkers=None):
     """
     Given the scan type (scanType) and the data Directory (dataDirectory), this function finds the zip
-    files that correspond to DICOM data, extracts them to a temporary folder, and the identifies
-    within them the DICOM files that correspond to DICOM files of the requested scan.
+    files that correspond to DICOM data, and the identifies within them the DICOM files that
+    correspond to DICOM files of the requested scan. See retrieveAllDicomFiles.
     :param scanType: can be "Macular Cube", "Angiography 3x3", or "Angiography 8x8".
     :param dataDirectory: the root-level directory containing the DICOM data.
-    :return: a list of filenames that will then be parsed for relevant volumentric data.
+    :param numWorkers: the number of threads reading DICOM headers.
+    :return: the temporary directories, none are created anymore, and a list of metadata records
+    (see readDicomMetadata) that will then be aggregated into the volumetric properties.
     """
+    tmpDirectoriesCreated, dicomFilesPerScanType = retrieveAllDicomFiles([scanType], dataDirectory, numWorkers)
+    return tmpDirectoriesCreated, dicomFilesPerScanType[scanType]
+
 
-    if "Macular Cube" not in scanType and \
-            "Angiography 8x8" not in scanType and \
-            "Angiography 3x3" not in scanType:
-        print('Error: Only types of ''Macular Cube'', ''Angiography 3x3'', or ''Angiography 8x8'' are expected.')
-        exit(1)
+def retrieveAllDicomFiles(scanTypes, dataDirectory, numWorkers=None, index=None):
+    """
+    Given the scan types (scanTypes) and the data Directory (dataDirectory), this function finds the zip
+    files that correspond to DICOM data, and groups the DICOM files within them by scan type in a
+    single pass. The archives are not extracted: only the headers of the DICOM members are read
+    from them, each once, across a pool of numWorkers threads.
+    With an index, unchanged archives are not opened at all, and only the new or changed members
+    of other archives are read. The headers read are stored in the index for the next run.
+    :param scanTypes: a list of "Macular Cube", "Angiography 3x3", or "Angiography 8x8".
+    :param dataDirectory: the root-level directory containing the DICOM data.
+    :param numWorkers: the number of threads reading DICOM headers.
+    :param index: a ZeissMetadataIndex.DicomMetadataIndex, or None to read every header.
+    :return: the temporary directories, none are created anymore, and a dictionary with the list of
+    metadata records (see readDicomMetadata) of every scan type.
+    :raise UnknownScanTypeError: for scan types other than those of SCAN_TYPES.
+    """
 
-    tmpDir = "/tmp/" # os.getcwd()
-    cleanUpTempFolders(tmpDir + "IMGExportFiles/")
+    for scanType in scanTypes:
+        if "Macular Cube" not in scanType and \
+                "Angiography 8x8" not in scanType and \
+                "Angiography 3x3" not in scanType:
+            raise UnknownScanTypeError("Only types of 'Macular Cube', 'Angiography 3x3', or 'Angiography 8x8' "
+                                       "are expected, not '" + scanType + "'.")
 
     # Retrieve list of zip files that contain DICOM data in root-directory
     zipFilenameList = []
@@ -146,219 +381,318 @@ def retrieveDicomFiles(scanType, dataDirectory):
                 zipPathList.append(dirpath)
 
 
-    # Unzip the DICOM folders
-    directoriesToCreate = []
-    for idx in range(0, len(zipFilenameList)):
-        zipPath = zipPathList[idx]
-        dicomZipFile = zipFilenameList[idx]
+    # Go through all the zip files and retrieve all DICOM members
+    approvedDicomFiles = {scanType: [] for scanType in scanTypes}
+    with ThreadPoolExecutor(max_workers=numWorkers) as executor:
+        for idx in range(0, len(zipFilenameList)):
+            zipPath = zipPathList[idx]
+            dicomZipFile = os.path.join(zipPath, zipFilenameList[idx])
+            if index is not None and index.isArchiveUnchanged(dicomZipFile):
+                records = index.archiveRecords(dicomZipFile)
+            else:
+                dcmFilenameList = listZipMembers(dicomZipFile,
+                                                 lambda memberName: ".DCM" in os.path.basename(memberName))
+                records = readArchiveMetadata(scanTypes, dicomZipFile, dcmFilenameList, executor, index)
+
+            # Go through all DICOM headers and see which scanType they talk about
+            for record in records:
+                if record is not None and record["scanType"] in approvedDicomFiles:
+                    approvedDicomFiles[record["scanType"]].append(record)
+
+    return [], approvedDicomFiles
 
-        directoryToCreate = tmpDir + dicomZipFile[:-4]
 
-        # Create a directory for the archive
-        directoriesToCreate.append(directoryToCreate)
-        if not os.path.exists(directoryToCreate):
-            os.makedirs(directoryToCreate)
+def readArchiveMetadata(scanTypes, zipFilename, dcmFilenameList, executor, index=None):
+    """
+    Reads the headers of the DICOM members of one archive on the threads of executor. With an
+    index, the headers of all scan types are read, members that are already indexed with the
+    same size and modification time are not read again, the properties of the new members are
+    parsed once per scan type (see parsePropertyRecords), and the index is updated.
+    :return: a list of metadata records (see readDicomMetadata), None for members of other scan types.
+    """
+    if index is None:
+        return list(executor.map(lambda dicomFilename: readDicomMetadata(scanTypes, dicomFilename),
+                                 dcmFilenameList))
 
-        # Grab the entire path of the zip file
-        zipFileObject = zipfile.ZipFile(zipPath + dicomZipFile)
+    records = [index.memberRecord(dicomFilename) for dicomFilename in dcmFilenameList]
+    missing = [idx for idx, record in enumerate(records) if record is None]
+    for idx, record in zip(missing, executor.map(
+            lambda idx: readDicomMetadata(SCAN_TYPES, dcmFilenameList[idx], keepUnmatched=True), missing)):
+        records[idx] = record
+    parsePropertyRecords(records)
+    index.storeArchive(zipFilename, list(zip(dcmFilenameList, records)))
+    return records
 
-        # Extract it in the newly generated folder
-        zipFileObject.extractall(directoryToCreate)
 
-    # Go through all the folders and retrieve all DICOM files
-    dcmFilenameList = []
-    for dicomDirectory in directoriesToCreate:
-        for (dirpath, dirnames, filenames) in walk(dicomDirectory):
-            for filename in filenames:
-                if ".DCM" in filename:
-                    dcmFilenameList.append(dirpath + "/" + filename)
+# Tags read from every DICOM header, PixelSpacing holds the pixel width and the pixel depth
+DICOM_TAGS = {"sliceThicknessInMM": (0x0018, 0x0088),  # SpacingBetweenSlices
+              "numberOfFrames": (0x0028, 0x0008),
+              "pixelSpacing": (0x0028, 0x0030),
+              "imageWidthInPixels": (0x0028, 0x0010),  # Rows
+              "imageDepthInPixels": (0x0028, 0x0011),  # Columns
+              "bitDepth": (0x0028, 0x0101)}  # BitsStored
 
-    # Go through all DICOM files and see whether they talk about scanType
-    approvedDicomFiles = []
-    for dicomFilename in dcmFilenameList:
-        dcm = pydicom.dcmread(dicomFilename)
-        codeMeaning = dcm[0x40, 0x260][0][0x08, 0x104].value
-        if scanType in codeMeaning:
-            approvedDicomFiles.append(dicomFilename)
+PROPERTY_NAMES = ["sliceThicknessInMM", "pixelWidthInMM", "pixelDepthInMM", "imageWidthInPixels",
+                  "imageDepthInPixels", "bitDepth"]
 
-    return directoriesToCreate, approvedDicomFiles
+NUMBER_PATTERN = re.compile(r'\d+\.?\d*(?:[eE][-+]?\d+)?|\.\d+(?:[eE][-+]?\d+)?')
 
 
-def parseDicom(scanType, dicomFilename):
+def tagNumbers(dcm, tag):
     """
-    Given a DICOM filename, it loads the dicom and returns sliceThicknessMM, imageWidthMM (left-right), imageDepthMM (z),
-    imageWidthPix, imageDepthPix, bitDepth.
-    :param scanType: can be "Macular Cube", "Angiography 3x3", or "Angiography 8x8".
-    :param dicomFilename: the path to the dicom file to be parsed.
-    :return: valid, sliceThicknessInMM, pixelWidthInMM, pixelDepthInMM, imageWidthInPixels, imageDepthInPixels, bitDepth
+    Reads the numbers of a tag. Some exports carry values that pydicom refuses to convert, padded
+    with NUL bytes or stray characters, those are read from the raw bytes of the element.
+    :return: a list of floats, empty if the tag is missing.
+    """
+    if tag not in dcm:
+        return []
+    try:
+        value = dcm[tag].value
+    except (ValueError, TypeError):
+        value = dcm.get_item(tag).value
+    if value is None:
+        return []
+    if isinstance(value, (bytes, bytearray)):
+        value = value.decode("latin-1")
+    if isinstance(value, str):
+        return [float(number) for number in NUMBER_PATTERN.findall(value.split('\x00')[0])]
+    if isinstance(value, (int, float)):
+        return [float(value)]
+    return [number for item in value for number in
+            (NUMBER_PATTERN.findall(item.split('\x00')[0]) if isinstance(item, str) else [item])]
+
+
+def extractDicomTags(dcm):
     """
-    valid = True
+    :param dcm: a DICOM header, as read by pydicom.
+    :return: a dictionary with the value of every property of PROPERTY_NAMES and of the number of
+    frames, NaN if missing.
+    """
+    import numpy as np
 
-    dcm = pydicom.dcmread(dicomFilename)
+    tags = {name: tagNumbers(dcm, tag) for name, tag in DICOM_TAGS.items()}
+    pixelSpacing = [float(number) for number in tags.pop("pixelSpacing")] + [np.nan, np.nan]
+    tags = {name: float(numbers[0]) if numbers else np.nan for name, numbers in tags.items()}
+    tags["pixelWidthInMM"] = pixelSpacing[0]
+    tags["pixelDepthInMM"] = pixelSpacing[1]
+    return tags
 
-    # Get the slice thickness and sanity check it.
-    try:
-        sliceThicknessInMM = dcm.SpacingBetweenSlices
-    except ValueError as e:
-        msg = str(e).split(": ")
-        sliceThicknessInMM = msg[1]
-    except AttributeError as e:
-        msg = str(e)
-        # print("Error - " + dicomFilename + " - " + msg)
-        sliceThicknessInMM = -1.0
-        valid = False
-
-    # Remove unicode characters as regular expressions and convert to float
-    if type(sliceThicknessInMM) is str:
-        sliceThicknessInMM = float(
-            re.sub('[^0-9.]', '', sliceThicknessInMM.split('\x00')[0]))
-
-    if type(sliceThicknessInMM) is valuerep.DSfloat:
-        sliceThicknessInMM = float(sliceThicknessInMM)
-
-    # Sanity checks
-    if sliceThicknessInMM == 0:
-        valid = False
-
-    # if "Angiography" in scanType:
-        # sliceThicknessInMM = 0
-
-     # Get the number of frames
-    try:
-        numberOfFrames = dcm.NumberOfFrames
-    except AttributeError as e:
-        msg = str(e)
-        # print("Error - " + dicomFilename + " - " + msg)
-        numberOfFrames = -1.0
-        valid = False
-
-    # Remove unicode characters as regular expressions and convert to float
-    if type(numberOfFrames) is str:
-        numberOfFrames = float(
-            re.sub('[^0-9.]', '', numberOfFrames.split('\x00')[0]))
-    if type(numberOfFrames) is valuerep.DSfloat:
-        numberOfFrames = float(numberOfFrames)
-
-    # Sanity check
-    if (scanType in "Macular Cube") and (numberOfFrames != 128):
-        valid = False
-
-    # Get pixel dimensions
-    try:
-        pixelSpacing = dcm.PixelSpacing
-        pixelSpacing = str(pixelSpacing).split(",")
-
-        pixelWidthInMM = pixelSpacing[0]
-        pixelDepthInMM = pixelSpacing[1]
-    except ValueError as e:
-        msg = str(e).split(": ")
-        dims = msg[1].split(",")
-        pixelWidthInMM = dims[0]
-        pixelDepthInMM = dims[1]
-    except AttributeError as e:
-        msg = str(e)
-        # print("Error - " + dicomFilename + " - " + msg)
-        valid = False
-
-    # Remove unicode characters as regular expressions and convert to float
-    pixelWidthInMM = float(
-        re.sub('[^0-9.]', '', pixelWidthInMM.split('\x00')[0]))
-    pixelDepthInMM = float(
-        re.sub('[^0-9.]', '', pixelDepthInMM.split('\x00')[0]))
-
-    # Sanity checks
-    if pixelWidthInMM == 0 or pixelDepthInMM == 0:
-        valid = False
 
+def parseDicomColumns(scanType, tagRows):
+    """
+    Validates the tags of many DICOM headers at once, as numpy columns.
+    :param scanType: can be "Macular Cube", "Angiography 3x3", or "Angiography 8x8".
+    :param tagRows: a list of dictionaries, as returned by extractDicomTags.
+    :return: a dictionary with a float column for numberOfFrames and every property of
+    PROPERTY_NAMES, NaN where missing, and the boolean column "valid".
+    """
+    import numpy as np
+
+    columns = {name: np.array([row[name] for row in tagRows], dtype=np.float64)
+               for name in PROPERTY_NAMES + ["numberOfFrames"]}
+
+    # Comparisons with NaN are False, so missing tags are invalid
+    valid = (columns["sliceThicknessInMM"] != 0) & ~np.isnan(columns["sliceThicknessInMM"])
+    valid &= ~np.isnan(columns["numberOfFrames"])
+    if scanType in "Macular Cube":
+        valid &= columns["numberOfFrames"] == 128
+    valid &= (columns["pixelWidthInMM"] != 0) & (columns["pixelDepthInMM"] != 0)
+    valid &= ~np.isnan(columns["pixelWidthInMM"]) & ~np.isnan(columns["pixelDepthInMM"])
     # Isotropic in pixelWidth and sliceThickness for Angiography
     if "Angiography" in scanType:
-        if abs(pixelWidthInMM - sliceThicknessInMM) > 0.0005:
-            valid = False
+        valid &= np.abs(columns["pixelWidthInMM"] - columns["sliceThicknessInMM"]) <= 0.0005
+    valid &= columns["bitDepth"] == 8
+    valid &= (columns["imageWidthInPixels"] > 0) & (columns["imageDepthInPixels"] > 0)
+
+    columns["valid"] = valid
+    return columns
+
+
+def columnProperties(columns):
+    """
+    :param columns: the columns of parseDicomColumns.
+    :return: a list with the properties of every row, valid, sliceThicknessInMM, pixelWidthInMM,
+    pixelDepthInMM, imageWidthInPixels, imageDepthInPixels, bitDepth, with -1 for missing spacings
+    and 0 for missing dimensions.
+    """
+    import numpy as np
+
+    spacings = [np.nan_to_num(columns[name], nan=-1.0).tolist() for name in PROPERTY_NAMES[:3]]
+    dimensions = [np.nan_to_num(columns[name], nan=0.0).astype(int).tolist() for name in PROPERTY_NAMES[3:]]
+    return list(zip(columns["valid"].tolist(), *(spacings + dimensions)))
+
+
+def parsePropertyRecords(records):
+    """
+    Parses the properties of the metadata records that are not parsed yet, with one
+    parseDicomColumns call per scan type.
+    :param records: a list of metadata records (see readDicomMetadata), or None.
+    """
+    for scanType in SCAN_TYPES:
+        unparsed = [record for record in records if record is not None and record["scanType"] == scanType and
+                    record["properties"] is None]
+        if unparsed:
+            for record, properties in zip(unparsed, columnProperties(
+                    parseDicomColumns(scanType, [record["tags"] for record in unparsed]))):
+                record["properties"] = properties
+
+
+def parseDicom(scanType, dicomFilename):
+    """
+    Given a DICOM filename, it loads the dicom and returns sliceThicknessMM, imageWidthMM (left-right), imageDepthMM (z),
+    imageWidthPix, imageDepthPix, bitDepth.
+    :param scanType: can be "Macular Cube", "Angiography 3x3", or "Angiography 8x8".
+    :param dicomFilename: the path to the dicom file to be parsed, or its already read header.
+    :return: valid, sliceThicknessInMM, pixelWidthInMM, pixelDepthInMM, imageWidthInPixels, imageDepthInPixels, bitDepth,
+    with -1 for missing spacings and 0 for missing dimensions.
+    """
+    import pydicom
 
-    imageWidthInPixels = dcm.Rows
-    imageDepthInPixels = dcm.Columns
-    bitDepth = dcm.BitsStored
+    if isinstance(dicomFilename, pydicom.Dataset):
+        dcm = dicomFilename
+    else:
+        dcm = pydicom.dcmread(dicomFilename, stop_before_pixels=True)
 
-    if bitDepth != 8:
-        print("Error - expecting 8 bit depth - " + bitDepth + " found.")
-        valid = False
+    columns = parseDicomColumns(scanType, [extractDicomTags(dcm)])
+    if columns["bitDepth"][0] != 8:
+        logger.warning("Error - expecting 8 bit depth - " + str(columns["bitDepth"][0]) + " found.")
 
-    # Sanity checks
-    if imageWidthInPixels == 0 or imageDepthInPixels == 0 or bitDepth == 0:
-        valid = False
+    return columnProperties(columns)[0]
 
-    return valid, sliceThicknessInMM, pixelWidthInMM, pixelDepthInMM, imageWidthInPixels, imageDepthInPixels, bitDepth
+
+def propertyColumns(scanType, dicomFilenames):
+    """
+    Validates the tags of all files at once, with a single parseDicomColumns call.
+    :param dicomFilenames: a list of metadata records (see readDicomMetadata), or of dicom filenames
+    whose headers are read here. Records read from an index are already parsed.
+    :return: the columns of the properties of all files, see parseDicomColumns.
+    """
+    import numpy as np
+    import pydicom
+
+    properties = np.zeros((len(dicomFilenames), len(PROPERTY_NAMES) + 1))
+    tagRows = []
+    tagRowIndices = []
+    for idx, dicomFilename in enumerate(dicomFilenames):
+        if isinstance(dicomFilename, dict) and dicomFilename["properties"] is not None:
+            properties[idx] = dicomFilename["properties"]
+        elif isinstance(dicomFilename, dict) and dicomFilename.get("tags") is not None:
+            tagRows.append(dicomFilename["tags"])
+            tagRowIndices.append(idx)
+        else:
+            if isinstance(dicomFilename, dict):
+                dicomFilename = dicomFilename["filename"]
+            tagRows.append(extractDicomTags(pydicom.dcmread(dicomFilename, stop_before_pixels=True)))
+            tagRowIndices.append(idx)
+
+    if tagRows:
+        parsed = parseDicomColumns(scanType, tagRows)
+        properties[tagRowIndices, 0] = parsed["valid"]
+        for column, name in enumerate(PROPERTY_NAMES, 1):
+            properties[tagRowIndices, column] = parsed[name]
+        for idx in np.flatnonzero(parsed["bitDepth"] != 8):
+            logger.warning("Error - expecting 8 bit depth - " + str(parsed["bitDepth"][idx]) + " found.")
+
+    columns = {name: properties[:, column] for column, name in enumerate(PROPERTY_NAMES, 1)}
+    columns["valid"] = properties[:, 0].astype(bool)
+    return columns
+
+
+def consensusDicomProperties(columns, relativeTolerance=1e-3):
+    """
+    Computes the consensus of the properties of the valid files that are in range: the median of
+    the spacings and the most frequent of the dimensions and bit depths.
+    :param columns: the columns of the properties, see propertyColumns.
+    :return: the consensus sliceThicknessInMM, pixelWidthInMM, pixelDepthInMM, imageWidthInPixels,
+    imageDepthInPixels, bitDepth, the mask of the files used, and the mask of the used files with
+    at least one property that differs from the consensus.
+    :raise MissingDataError: if no file is valid and in range.
+    """
+    import numpy as np
+
+    # sliceThicknessInMM cannot really be more than 1mm
+    used = columns["valid"] & (columns["sliceThicknessInMM"] <= 1.0) & (columns["imageWidthInPixels"] >= 1.0) & \
+        (columns["imageDepthInPixels"] >= 1.0) & (columns["bitDepth"] >= 4.0)
+    if not used.any():
+        raise MissingDataError("No valid DICOM file in range out of " + str(len(used)) + " files.")
+
+    consensus = []
+    outliers = np.zeros(len(used), dtype=bool)
+    for name in PROPERTY_NAMES:
+        values = columns[name][used]
+        if name.endswith("InMM"):
+            value = np.median(values)
+            outliers[used] |= ~np.isclose(values, value, rtol=relativeTolerance, atol=0.0)
+        else:
+            uniqueValues, counts = np.unique(values, return_counts=True)
+            value = int(uniqueValues[np.argmax(counts)])
+            outliers[used] |= values != value
+        consensus.append(value)
+
+    return tuple(consensus) + (used, outliers)
 
 
 def aggregateDicomProperties(scanType, dicomFilenames):
     """
     Each DICOM file that is parsed gives a separate set of properties. This function
     aims to find the ones that appear consistently, in order to consider them
-    as the final properties for this particular scan.
+    as the final properties for this particular scan. Files that are invalid or out of range
+    are ignored, and the files that disagree with the consensus are reported.
     :param scanType: can be "Macular Cube", "Angiography 3x3", or "Angiography 8x8".
-    :param dicomFilenames: a list of all dicom files to be considered.
+    :param dicomFilenames: a list of the metadata records (see readDicomMetadata) of all
+    dicom files to be considered. Plain filenames are parsed here.
     :return: sliceThicknessInMM, pixelWidthInMM, pixelDepthInMM, imageWidthInPixels, imageDepthInPixels, bitDepth
+    :raise MissingDataError: if no file is valid and in range.
     """
-    sliceThicknessInMM = []
-    pixelWidthInMM = []
-    pixelDepthInMM = []
-    imageWidthInPixels = []
-    # imageWidthPerPixel = []
-    imageDepthInPixels = []
-    # imageDepthPerPixel = []
-    bitDepth = []
-
-    for dicomFilename in dicomFilenames:
-        # print('\nParsing file: ' + dicomFilename)
-        properties = parseDicom(scanType, dicomFilename)
-        # print("DICOM properties: ")
-        # print(properties)
-        if properties[0]:
-            # sliceThicknessInMM cannot really be more than 1mm
-            if (properties[1] > 1.0) or  \
-                    properties[4] < 1.0 or \
-                    properties[5] < 1.0 or \
-                    properties[6] < 4.0:
-                # print("Ignoring.")
-                break
-
-
-            sliceThicknessInMM.append(properties[1])
-            # imageWidthInMM w.r.t. imageWidthInPixels may be different, so, consider the per pixel value
-            pixelWidthInMM.append(properties[2])
-            # imageWidthPerPixel.append(properties[2]/properties[4])
-
-            # imageDepthInMM w.r.t. imageDepthInPixels may be different, so, consider the per pixel value
-            pixelDepthInMM.append(properties[3])
-            # imageDepthPerPixel.append(properties[3]/properties[5])
-
-            imageWidthInPixels.append(properties[4])
-            imageDepthInPixels.append(properties[5])
-            bitDepth.append(properties[6])
-
-
-    # Return the average of all values for now. Seems that apart from a size difference,
-    # they are all identical.
-    sliceThicknessInMM = np.average(np.asarray(sliceThicknessInMM))
-    # imageWidthPerPixel = np.average(np.asarray(imageWidthPerPixel))
-    # imageDepthPerPixel = np.average(np.asarray(imageDepthPerPixel))
-    bitDepth = np.average(np.asarray(bitDepth))
-
-    # imageWidthInMM = imageWidthPerPixel * imageWidthInPixels[0]
-    # imageDepthInMM = imageDepthPerPixel * imageDepthInPixels[0]
-    pixelWidthInMM = np.average(np.asarray(pixelWidthInMM))
-    pixelDepthInMM = np.average(np.asarray(pixelDepthInMM))
-
-    print("\n==" + scanType + "==")
-    print("sliceThickness = " + str(1000*sliceThicknessInMM) + " um")
-    print("pixelWidth = " + str(1000*pixelWidthInMM) + " um")
-    print("pixelDepth = " + str(1000*pixelDepthInMM) + " um")
-    print("imageWidthInPixels = " + str(imageWidthInPixels[0]))
-    print("imageDepthInPixels = " + str(imageDepthInPixels[0]))
-    print("bitDepth = " + str(bitDepth) + "\n")
+    import numpy as np
+
+    columns = propertyColumns(scanType, dicomFilenames)
+    sliceThicknessInMM, pixelWidthInMM, pixelDepthInMM, imageWidthInPixels, imageDepthInPixels, bitDepth, used, \
+        outliers = consensusDicomProperties(columns)
+
+    def filename(idx):
+        dicomFilename = dicomFilenames[idx]
+        return str(dicomFilename["filename"] if isinstance(dicomFilename, dict) else dicomFilename)
+
+    logger.info("\n==" + scanType + "==")
+    if not used.all():
+        logger.warning("Ignoring " + str(np.count_nonzero(~used)) + " invalid or out of range files: " +
+              ", ".join(filename(idx) for idx in np.flatnonzero(~used)))
+    for idx in np.flatnonzero(outliers):
+        logger.warning("Outlier - " + filename(idx) + " - " +
+              ", ".join(name + " = " + str(columns[name][idx]) for name in PROPERTY_NAMES))
+    logger.info("sliceThickness = " + str(1000*sliceThicknessInMM) + " um")
+    logger.info("pixelWidth = " + str(1000*pixelWidthInMM) + " um")
+    logger.info("pixelDepth = " + str(1000*pixelDepthInMM) + " um")
+    logger.info("imageWidthInPixels = " + str(imageWidthInPixels))
+    logger.info("imageDepthInPixels = " + str(imageDepthInPixels))
+    logger.info("bitDepth = " + str(bitDepth) + "\n")
 
     return sliceThicknessInMM, pixelWidthInMM, pixelDepthInMM, \
-           imageWidthInPixels[0], imageDepthInPixels[0], bitDepth
+           imageWidthInPixels, imageDepthInPixels, bitDepth
+
+
+def convertDirectory(scanTypes, dataDirectory, numWorkers=None, outputFormat="nii", index=None):
+    """
+    Creates the nifti images of all scanTypes of a directory in a single pass: every archive is
+    opened once, every DICOM header is read once, and the IMGExport zip file is listed once.
+    :param scanTypes: a list of "Macular Cube", "Angiography 3x3", or "Angiography 8x8".
+    :param dataDirectory: the root-level directory containing the DICOM and IMG data.
+    :param numWorkers: the number of threads reading DICOM headers, and compressing "nii.gz" output.
+    :param outputFormat: the format of the images, see niftiFilename.
+    :param index: a ZeissMetadataIndex.DicomMetadataIndex caching the DICOM headers, see retrieveAllDicomFiles.
+    :return: a dictionary with the image of every scan type, to be closed with closeVolume.
+    """
+    tmpDirectoriesCreated, dicomFilesPerScanType = retrieveAllDicomFiles(scanTypes, dataDirectory, numWorkers,
+                                                                         index)
+    rawDataMembers = listRawDataMembers(dataDirectory)
+
+    niftis = {}
+    for scanType in scanTypes:
+        properties = aggregateDicomProperties(scanType, dicomFilesPerScanType[scanType])
+        niftis[scanType], tmpDirectoriesCreated = createNifty(scanType, dataDirectory, properties, rawDataMembers,
+                                                                 outputFormat=outputFormat, numThreads=numWorkers)
+    return niftis
 
 
 def cleanUpTempFolders(directoriesToRemove):
@@ -378,16 +712,21 @@ def cleanUpTempFolders(directoriesToRemove):
 
 
 def help():
-    print("zeissDICOMParser.py -i <inputdirectory> -t <scantype>")
+    print("zeissDICOMParser.py -i <inputdirectory> -t <scantype> [-r] [-f <" + "|".join(OUTPUT_FORMATS) + ">] "
+          "[-c <index.db>]")
 
 
 if __name__ == "__main__":
 
     # print("Warning - Slice Thickness in Angiography scans is not properly retrieved.")
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
 
     recursive = False
+    outputFormat = "nii"
+    index = None
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hi:t:r", ["inputdirectory=", "scantype=", "recursive="])
+        opts, args = getopt.getopt(sys.argv[1:], "hi:t:rf:c:",
+                                   ["inputdirectory=", "scantype=", "recursive=", "format=", "index="])
     except getopt.GetoptError:
         help()
         sys.exit(2)
@@ -402,9 +741,17 @@ if __name__ == "__main__":
         elif opt in ("-r", "--recursive"):
             recursive = True
             print("Parsing recursively.")
+        elif opt in ("-f", "--format"):
+            outputFormat = arg
+        elif opt in ("-c", "--index"):
+            index = DicomMetadataIndex(arg)
+
+    if outputFormat not in OUTPUT_FORMATS:
+        help()
+        sys.exit(2)
 
     if scanType == "All" or scanType == "all":
-        scanTypes = ["Macular Cube", "Angiography 8x8", "Angiography 3x3"]
+        scanTypes = SCAN_TYPES
         print("Parsing all scans.")
     else:
         scanTypes = []
@@ -421,16 +768,12 @@ if __name__ == "__main__":
 
     for dataDirectory in dataDirectories:
         try:
-            for scanType in scanTypes:
-                print("Parsing " + dataDirectory + ".")
-                tmpDirectoriesCreated, dicomFilenames = retrieveDicomFiles(scanType, dataDirectory)
-                properties = aggregateDicomProperties(scanType, dicomFilenames)
-                cleanUpTempFolders(tmpDirectoriesCreated)
-
-                nifti, tmpDirectoriesCreated = createNifty(scanType, dataDirectory, properties)
-                cleanUpTempFolders(tmpDirectoriesCreated)
-        except:
-            print("Omit this directory.")
+            print("Parsing " + dataDirectory + ".")
+            niftis = convertDirectory(scanTypes, dataDirectory, outputFormat=outputFormat, index=index)
+            for nifti in niftis.values():
+                closeVolume(nifti)
+        except Exception as e:
+            print("Omit this directory: " + str(e))
 
 
 
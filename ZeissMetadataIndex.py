@@ -0,0 +1,227 @@
+#
+# Persistent SQLite index of the DICOM properties parsed from the Zeiss Cirrus OCT
+# archives. Every DICOM member is keyed by the path of its archive, its member name,
+# its size and its modification time, so re-scans of unchanged archives do not read
+# them again, and cohorts can be selected with queries that never open a zip file.
+#
+
+import os, sys, getopt
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS archives (
+    archive TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS dicomMembers (
+    archive TEXT NOT NULL,
+    member TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime TEXT NOT NULL,
+    scanType TEXT,
+    codeMeaning TEXT,
+    valid INTEGER,
+    sliceThicknessInMM REAL,
+    pixelWidthInMM REAL,
+    pixelDepthInMM REAL,
+    numberOfFrames INTEGER,
+    imageWidthInPixels INTEGER,
+    imageDepthInPixels INTEGER,
+    bitDepth INTEGER,
+    PRIMARY KEY (archive, member)
+);
+CREATE INDEX IF NOT EXISTS dicomMembersByScanType ON dicomMembers (scanType, valid, bitDepth);
+"""
+
+PROPERTY_COLUMNS = ["valid", "sliceThicknessInMM", "pixelWidthInMM", "pixelDepthInMM", "imageWidthInPixels",
+                    "imageDepthInPixels", "bitDepth"]
+
+
+def archiveKey(archivePath):
+    """
+    :return: the absolute path, the size and the modification time in ns of an archive.
+    """
+    stat = os.stat(archivePath)
+    return os.path.abspath(archivePath), stat.st_size, stat.st_mtime_ns
+
+
+def memberKey(zipMember):
+    """
+    :return: the member name, the uncompressed size and the modification time of a ZipMember,
+    as recorded in the central directory of its archive.
+    """
+    return zipMember.name, zipMember.size, "{:04d}-{:02d}-{:02d}T{:02d}:{:02d}:{:02d}".format(
+        *zipMember.zipInfo.date_time)
+
+
+class DicomMetadataIndex:
+    """
+    SQLite index of the metadata records of DICOM members (see ZeissDicomParser.readDicomMetadata).
+    Members that do not belong to any scan type are indexed with a NULL scanType, so that they
+    are not read again either.
+    """
+    def __init__(self, indexFilename):
+        self.indexFilename = indexFilename
+        # Concurrent converters wait for each other's writes instead of failing
+        self.connection = sqlite3.connect(indexFilename, timeout=60)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+
+    def isArchiveUnchanged(self, archivePath):
+        """
+        :return: True if the archive was fully indexed with its current size and modification time.
+        """
+        archive, size, mtime = archiveKey(archivePath)
+        row = self.connection.execute("SELECT size, mtime FROM archives WHERE archive = ?", (archive,)).fetchone()
+        return row is not None and row["size"] == size and row["mtime"] == mtime
+
+    def archiveRecords(self, archivePath):
+        """
+        :return: the records of all indexed members of an archive, without opening it.
+        """
+        rows = self.connection.execute("SELECT * FROM dicomMembers WHERE archive = ? ORDER BY member",
+                                       (os.path.abspath(archivePath),))
+        return [self._record(row) for row in rows]
+
+    def memberRecord(self, zipMember):
+        """
+        :return: the indexed record of a ZipMember, or None if the member is not indexed or has changed.
+        """
+        name, size, mtime = memberKey(zipMember)
+        row = self.connection.execute("SELECT * FROM dicomMembers WHERE archive = ? AND member = ?",
+                                      (os.path.abspath(zipMember.archive), name)).fetchone()
+        if row is None or row["size"] != size or row["mtime"] != mtime:
+            return None
+        return self._record(row)
+
+    def storeArchive(self, archivePath, memberRecords):
+        """
+        Replaces the indexed members of an archive in one transaction.
+        :param memberRecords: a list of (ZipMember, record) pairs, with records as returned by
+        ZeissDicomParser.readDicomMetadata.
+        """
+        archive, size, mtime = archiveKey(archivePath)
+        with self.connection:
+            self.connection.execute("DELETE FROM dicomMembers WHERE archive = ?", (archive,))
+            for zipMember, record in memberRecords:
+                properties = record["properties"] or (None,) * len(PROPERTY_COLUMNS)
+                self.connection.execute(
+                    "INSERT INTO dicomMembers VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (archive,) + memberKey(zipMember) +
+                    (record["scanType"], record["codeMeaning"], properties[0], properties[1], properties[2],
+                     properties[3], record["numberOfFrames"], properties[4], properties[5], properties[6]))
+            self.connection.execute("INSERT OR REPLACE INTO archives VALUES (?, ?, ?)", (archive, size, mtime))
+
+    def queryScans(self, scanType=None, valid=None, bitDepth=None, archivePrefix=None):
+        """
+        Selects indexed DICOM members, e.g. queryScans("Angiography 3x3", valid=True, bitDepth=8).
+        :param scanType: "Macular Cube", "Angiography 3x3", or "Angiography 8x8", or None for all scan types.
+        :param valid: True or False to select on the validity decision of parseDicom.
+        :param bitDepth: the bits stored per voxel.
+        :param archivePrefix: selects the archives below a directory.
+        :return: a list of metadata records.
+        """
+        conditions = ["scanType IS NOT NULL"]
+        parameters = []
+        if scanType is not None:
+            conditions.append("scanType = ?")
+            parameters.append(scanType)
+        if valid is not None:
+            conditions.append("valid = ?")
+            parameters.append(int(valid))
+        if bitDepth is not None:
+            conditions.append("bitDepth = ?")
+            parameters.append(bitDepth)
+        if archivePrefix is not None:
+            conditions.append("archive LIKE ? ESCAPE '\\'")
+            prefix = os.path.abspath(archivePrefix).replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            parameters.append(prefix + "%")
+        rows = self.connection.execute("SELECT * FROM dicomMembers WHERE " + " AND ".join(conditions) +
+                                       " ORDER BY archive, member", parameters)
+        return [self._record(row) for row in rows]
+
+    def queryArchives(self, scanType=None, valid=None, bitDepth=None, archivePrefix=None):
+        """
+        :return: the sorted paths of the archives with at least one member selected by queryScans.
+        """
+        return sorted(set(record["archive"] for record in self.queryScans(scanType, valid, bitDepth, archivePrefix)))
+
+    def close(self):
+        self.connection.close()
+
+    def _record(self, row):
+        properties = None
+        if row["scanType"] is not None:
+            properties = (bool(row["valid"]),) + tuple(row[column] for column in PROPERTY_COLUMNS[1:])
+        return {"filename": row["archive"] + ":" + row["member"],
+                "archive": row["archive"],
+                "member": row["member"],
+                "scanType": row["scanType"],
+                "codeMeaning": row["codeMeaning"],
+                "numberOfFrames": row["numberOfFrames"],
+                "properties": properties}
+
+
+def updateIndex(rootDirectory, indexFilename, numWorkers=None):
+    """
+    Indexes the DICOM archives of every RIDE_ directory below rootDirectory.
+    :return: the number of indexed directories.
+    """
+    import ZeissDicomParser
+
+    dataDirectories = [os.path.join(root, subdir) + "/" for (root, subdirs, files) in os.walk(rootDirectory)
+                       for subdir in subdirs if "RIDE_" in subdir]
+    index = DicomMetadataIndex(indexFilename)
+    try:
+        for dataDirectory in sorted(dataDirectories):
+            ZeissDicomParser.retrieveAllDicomFiles(ZeissDicomParser.SCAN_TYPES, dataDirectory, numWorkers, index)
+    finally:
+        index.close()
+    return len(dataDirectories)
+
+
+def help():
+    print("ZeissMetadataIndex.py -d <index.db> [-i <rootdirectory>] [-t <scantype>] [-b <bitdepth>] [-v]")
+
+
+if __name__ == "__main__":
+
+    indexFilename = None
+    rootDirectory = None
+    scanType = None
+    bitDepth = None
+    valid = None
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hd:i:t:b:v",
+                                   ["index=", "inputdirectory=", "scantype=", "bitdepth=", "valid"])
+    except getopt.GetoptError:
+        help()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            help()
+            sys.exit()
+        elif opt in ("-d", "--index"):
+            indexFilename = arg
+        elif opt in ("-i", "--inputdirectory"):
+            rootDirectory = arg
+        elif opt in ("-t", "--scantype"):
+            scanType = arg
+        elif opt in ("-b", "--bitdepth"):
+            bitDepth = int(arg)
+        elif opt in ("-v", "--valid"):
+            valid = True
+
+    if indexFilename is None:
+        help()
+        sys.exit(2)
+
+    if rootDirectory is not None:
+        print("Indexed {} directories.".format(updateIndex(rootDirectory, indexFilename)))
+
+    index = DicomMetadataIndex(indexFilename)
+    for archive in index.queryArchives(scanType, valid, bitDepth):
+        print(archive)
+    index.close()
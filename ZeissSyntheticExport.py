@@ -0,0 +1,171 @@
+#
+# Generates synthetic exports that look like those of the Zeiss Cirrus OCT machine, so
+# that ZeissDicomParser can be benchmarked and regression-tested without patient data.
+# An export is a RIDE_ directory with a DICOM zip archive, whose DICOM files carry the
+# CodeMeaning, SpacingBetweenSlices, PixelSpacing and NumberOfFrames tags read by the
+# parser, and an IMGExportFiles zip archive with the matching cube_raw and FlowCube_raw
+# files.
+#
+
+import os, sys, getopt
+import io
+import zipfile
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+# CodeMeaning, raw file suffix, slice thickness in mm and pixel spacing (width, depth) in mm of every scan type
+SCAN_PROTOCOLS = {
+    "Macular Cube": ("Macular Cube 512x128", "cube_raw", 0.047, (0.0117, 0.002)),
+    "Angiography 3x3": ("Angiography 3x3 mm", "FlowCube_raw", 0.0122, (0.0122, 0.002)),
+    "Angiography 8x8": ("Angiography 8x8 mm", "FlowCube_raw", 0.0229, (0.0229, 0.002)),
+}
+
+# Ophthalmic Tomography Image Storage
+SOP_CLASS_UID = "1.2.840.10008.5.1.4.1.1.77.1.5.4"
+
+# Synthetic export sizes: DICOM files per scan type, A-scans per B-scan, depth in pixels and
+# B-scans of the angiography cubes (Macular Cubes always have 128 B-scans)
+EXPORT_SIZES = {
+    "small": (2, 64, 128, 32),
+    "medium": (8, 256, 512, 128),
+    "large": (32, 512, 1024, 245),
+}
+
+
+def createSyntheticDicom(codeMeaning, numberOfFrames, imageWidthInPixels, imageDepthInPixels, sliceThicknessInMM,
+                         pixelSpacing, rng, withPixelData=True):
+    """
+    :param pixelSpacing: the pixel width and the pixel depth in mm.
+    :param withPixelData: adds numberOfFrames random frames, as large as those of a real export.
+    :return: the bytes of a DICOM file.
+    """
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = SOP_CLASS_UID
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    dcm = FileDataset(None, {}, file_meta=meta, preamble=b"\0" * 128)
+    dcm.SOPClassUID = SOP_CLASS_UID
+    dcm.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    protocol = Dataset()
+    protocol.CodeMeaning = codeMeaning
+    dcm.PerformedProtocolCodeSequence = [protocol]
+    dcm.SpacingBetweenSlices = sliceThicknessInMM
+    dcm.NumberOfFrames = numberOfFrames
+    dcm.PixelSpacing = list(pixelSpacing)
+    dcm.Rows = imageWidthInPixels
+    dcm.Columns = imageDepthInPixels
+    dcm.SamplesPerPixel = 1
+    dcm.PhotometricInterpretation = "MONOCHROME2"
+    dcm.BitsAllocated = 8
+    dcm.BitsStored = 8
+    dcm.HighBit = 7
+    dcm.PixelRepresentation = 0
+    if withPixelData:
+        dcm.PixelData = rng.bytes(numberOfFrames * imageWidthInPixels * imageDepthInPixels)
+
+    dicomFile = io.BytesIO()
+    pydicom.dcmwrite(dicomFile, dcm)
+    return dicomFile.getvalue()
+
+
+def iterateSyntheticSlices(numSlices, imageWidthInPixels, imageDepthInPixels, rng):
+    """
+    Yields the B-scans of a raw cube, imageDepthInPixels x imageWidthInPixels voxels each: dark
+    speckle noise with a bright retina band, so that the cube compresses like real data.
+    """
+    depths = np.arange(imageDepthInPixels)[:, np.newaxis]
+    for sliceIndex in range(numSlices):
+        top = imageDepthInPixels // 3 + (np.sin(np.linspace(0, np.pi, imageWidthInPixels) + sliceIndex / 20.0) *
+                                         imageDepthInPixels / 16).astype(int)
+        band = (depths >= top) & (depths < top + imageDepthInPixels // 6)
+        rawSlice = rng.randint(0, 24, size=(imageDepthInPixels, imageWidthInPixels)).astype(np.uint8)
+        rawSlice[band] += rng.randint(120, 200, size=np.count_nonzero(band)).astype(np.uint8)
+        yield rawSlice
+
+
+def generateSyntheticExport(dataDirectory, scanTypes, numDicomFiles=2, imageWidthInPixels=64, imageDepthInPixels=128,
+                            numAngiographySlices=32, compression=zipfile.ZIP_DEFLATED, withPixelData=True, seed=0):
+    """
+    Writes a synthetic export into dataDirectory.
+    :param scanTypes: a list of "Macular Cube", "Angiography 3x3", or "Angiography 8x8".
+    :param numDicomFiles: the number of DICOM files of every scan type.
+    :param imageWidthInPixels: the number of A-scans of a B-scan.
+    :param imageDepthInPixels: the number of pixels of an A-scan.
+    :param numAngiographySlices: the number of B-scans of the angiography cubes.
+    :param compression: the compression of both zip archives, zipfile.ZIP_DEFLATED or zipfile.ZIP_STORED.
+    :return: a dictionary with the properties that aggregateDicomProperties should find for every scan
+    type, and the number of slices of its raw cube.
+    """
+    rng = np.random.RandomState(seed)
+    if not os.path.exists(dataDirectory):
+        os.makedirs(dataDirectory)
+
+    expected = {}
+    with zipfile.ZipFile(os.path.join(dataDirectory, "P1_DICOM.zip"), "w", compression) as dicomZip:
+        for scanIndex, scanType in enumerate(scanTypes):
+            codeMeaning, rawSuffix, sliceThicknessInMM, pixelSpacing = SCAN_PROTOCOLS[scanType]
+            numSlices = 128 if scanType == "Macular Cube" else numAngiographySlices
+            for fileIndex in range(numDicomFiles):
+                dicomZip.writestr("DataFiles/E{}{}/IMG{}.DCM".format(scanIndex, fileIndex, fileIndex),
+                                  createSyntheticDicom(codeMeaning, numSlices, imageWidthInPixels,
+                                                       imageDepthInPixels, sliceThicknessInMM, pixelSpacing, rng,
+                                                       withPixelData))
+            expected[scanType] = {"sliceThicknessInMM": sliceThicknessInMM, "pixelWidthInMM": pixelSpacing[0],
+                                  "pixelDepthInMM": pixelSpacing[1], "imageWidthInPixels": imageWidthInPixels,
+                                  "imageDepthInPixels": imageDepthInPixels, "numSlices": numSlices}
+
+    with zipfile.ZipFile(os.path.join(dataDirectory, "P1_IMGExportFiles.zip"), "w", compression) as imgZip:
+        for scanType in scanTypes:
+            codeMeaning, rawSuffix, sliceThicknessInMM, pixelSpacing = SCAN_PROTOCOLS[scanType]
+            # Raw cubes are streamed into the archive, one B-scan at a time
+            with imgZip.open("IMGExport/P1_" + codeMeaning + "_" + rawSuffix + ".img", "w",
+                             force_zip64=True) as rawFile:
+                for rawSlice in iterateSyntheticSlices(expected[scanType]["numSlices"], imageWidthInPixels,
+                                                       imageDepthInPixels, rng):
+                    rawFile.write(rawSlice.tobytes())
+
+    return expected
+
+
+def help():
+    print("ZeissSyntheticExport.py -o <outputdirectory> [-s <" + "|".join(EXPORT_SIZES) + ">] [-n <exports>] "
+          "[-u]")
+
+
+if __name__ == "__main__":
+
+    outputDirectory = None
+    exportSize = "small"
+    numExports = 1
+    compression = zipfile.ZIP_DEFLATED
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "ho:s:n:u", ["outputdirectory=", "size=", "exports=",
+                                                             "uncompressed"])
+    except getopt.GetoptError:
+        help()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            help()
+            sys.exit()
+        elif opt in ("-o", "--outputdirectory"):
+            outputDirectory = arg
+        elif opt in ("-s", "--size"):
+            exportSize = arg
+        elif opt in ("-n", "--exports"):
+            numExports = int(arg)
+        elif opt in ("-u", "--uncompressed"):
+            compression = zipfile.ZIP_STORED
+
+    if outputDirectory is None or exportSize not in EXPORT_SIZES:
+        help()
+        sys.exit(2)
+
+    for exportIndex in range(numExports):
+        dataDirectory = os.path.join(outputDirectory, "RIDE_{:04d}".format(exportIndex))
+        generateSyntheticExport(dataDirectory, list(SCAN_PROTOCOLS), *EXPORT_SIZES[exportSize],
+                                compression=compression, seed=exportIndex)
+        print("Synthetic export saved at " + dataDirectory)
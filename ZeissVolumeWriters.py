@@ -0,0 +1,242 @@
+#
+# Output backends for the OCT volumes converted by ZeissDicomParser. Volumes are written
+# slice by slice, as uncompressed or gzip-compressed NIfTI, or as Zarr or HDF5 arrays
+# chunked per slice, so that single B-scans can be read lazily. Every writer writes to
+# <name>.tmp and only renames it to its final name once the volume is complete, so that
+# a failed or killed conversion never leaves a truncated output behind.
+#
+
+import os
+import shutil
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# numpy, nibabel, zarr and h5py are imported by the writers that use them
+
+# Output formats and the extension of their files
+OUTPUT_FORMATS = {"nii": ".nii", "nii.gz": ".nii.gz", "zarr": ".zarr", "hdf5": ".h5"}
+
+NIFTI_VOX_OFFSET = 352
+
+
+def temporaryFilename(outputFilename):
+    return outputFilename + ".tmp"
+
+
+def replaceOutput(temporaryName, outputFilename):
+    """
+    Moves a complete output from its temporary name to outputFilename, replacing any previous output.
+    """
+    if os.path.isdir(outputFilename):
+        # Zarr arrays are directories, which os.replace cannot replace
+        shutil.rmtree(outputFilename)
+    os.replace(temporaryName, outputFilename)
+
+
+def removeOutput(filename):
+    if os.path.isdir(filename):
+        shutil.rmtree(filename, ignore_errors=True)
+    elif os.path.exists(filename):
+        os.remove(filename)
+
+
+class ParallelGzipFile:
+    """
+    Write-only file object that compresses blocks of blockSize bytes on numThreads threads
+    (zlib releases the GIL) and writes every block as its own gzip member, in order. A file of
+    concatenated gzip members is a valid gzip file for gzip, nibabel and other readers.
+    """
+    def __init__(self, filename, numThreads=None, blockSize=4 * 2 ** 20, compressLevel=6):
+        self.outputFile = open(filename, "wb")
+        self.numThreads = numThreads or os.cpu_count() or 1
+        self.blockSize = blockSize
+        self.compressLevel = compressLevel
+        self.executor = ThreadPoolExecutor(max_workers=self.numThreads)
+        self.pending = deque()
+        self.buffer = bytearray()
+
+    def _compress(self, block):
+        # wbits=31 writes a gzip header and trailer
+        compressor = zlib.compressobj(self.compressLevel, zlib.DEFLATED, 31)
+        return compressor.compress(block) + compressor.flush()
+
+    def _submit(self, block):
+        self.pending.append(self.executor.submit(self._compress, block))
+        # Bound the memory held by blocks in flight
+        while len(self.pending) > 2 * self.numThreads:
+            self.outputFile.write(self.pending.popleft().result())
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.blockSize:
+            self._submit(bytes(self.buffer[:self.blockSize]))
+            del self.buffer[:self.blockSize]
+
+    def close(self):
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self.outputFile.write(self.pending.popleft().result())
+        self.executor.shutdown()
+        self.outputFile.close()
+
+    def abort(self):
+        """
+        Discards the blocks in flight and closes the file without writing them.
+        """
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.pending.clear()
+        self.outputFile.close()
+
+
+class NiftiWriter:
+    """
+    Writes a uint8 volume as a single-file NIfTI image, optionally gzip-compressed.
+    """
+    def __init__(self, outputFilename, shape, affine, numThreads=None):
+        import numpy as np
+        import nibabel
+
+        self.outputFilename = outputFilename
+        niHdr = nibabel.Nifti1Header()
+        niHdr.set_data_shape(shape)
+        niHdr.set_data_dtype(np.uint8)
+        niHdr.set_xyzt_units('mm', 'sec')
+        # Same header fields as nibabel.save of a Nifti1Image with this affine
+        niHdr.set_qform(affine, code='unknown')
+        niHdr.set_sform(affine, code='aligned')
+        niHdr['magic'] = b'n+1'
+        niHdr.set_data_offset(NIFTI_VOX_OFFSET)
+
+        self.temporaryFilename = temporaryFilename(outputFilename)
+        if outputFilename.endswith(".gz"):
+            self.outputFile = ParallelGzipFile(self.temporaryFilename, numThreads)
+        else:
+            self.outputFile = open(self.temporaryFilename, "wb")
+        headerBytes = niHdr.binaryblock
+        # Empty extension flag up to the start of the voxel data
+        self.outputFile.write(headerBytes + b"\x00" * (NIFTI_VOX_OFFSET - len(headerBytes)))
+
+    def writeSlice(self, sliceIndex, volumeSlice):
+        import numpy as np
+
+        # Slices arrive in order, and a slice of a Fortran-ordered volume is contiguous
+        self.outputFile.write(np.ascontiguousarray(volumeSlice).tobytes())
+
+    def close(self):
+        import nibabel
+
+        self.outputFile.close()
+        replaceOutput(self.temporaryFilename, self.outputFilename)
+        return nibabel.load(self.outputFilename)
+
+    def abort(self):
+        if isinstance(self.outputFile, ParallelGzipFile):
+            self.outputFile.abort()
+        else:
+            self.outputFile.close()
+        removeOutput(self.temporaryFilename)
+
+
+class ZarrWriter:
+    """
+    Writes a uint8 volume as a Zarr array with one chunk per slice. The affine is kept in the
+    attributes of the array.
+    """
+    def __init__(self, outputFilename, shape, affine, numThreads=None):
+        import numpy as np
+        import zarr
+
+        self.outputFilename = outputFilename
+        self.temporaryFilename = temporaryFilename(outputFilename)
+        removeOutput(self.temporaryFilename)
+        self.array = zarr.open(self.temporaryFilename, mode="w", shape=shape, chunks=shape[:2] + (1,), dtype="uint8")
+        self.array.attrs["affine"] = np.asarray(affine).tolist()
+        self.array.attrs["units"] = "mm"
+
+    def writeSlice(self, sliceIndex, volumeSlice):
+        self.array[:, :, sliceIndex] = volumeSlice.T
+
+    def close(self):
+        import zarr
+
+        replaceOutput(self.temporaryFilename, self.outputFilename)
+        return zarr.open(self.outputFilename, mode="r")
+
+    def abort(self):
+        removeOutput(self.temporaryFilename)
+
+
+class Hdf5Writer:
+    """
+    Writes a uint8 volume as the gzip-compressed dataset "volume" of an HDF5 file, with one
+    chunk per slice. The affine is kept in the attributes of the dataset.
+    """
+    def __init__(self, outputFilename, shape, affine, numThreads=None):
+        import numpy as np
+        import h5py
+
+        self.outputFilename = outputFilename
+        self.temporaryFilename = temporaryFilename(outputFilename)
+        self.h5File = h5py.File(self.temporaryFilename, "w")
+        self.dataset = self.h5File.create_dataset("volume", shape=shape, dtype="uint8", chunks=shape[:2] + (1,),
+                                                  compression="gzip")
+        self.dataset.attrs["affine"] = np.asarray(affine)
+        self.dataset.attrs["units"] = "mm"
+
+    def writeSlice(self, sliceIndex, volumeSlice):
+        self.dataset[:, :, sliceIndex] = volumeSlice.T
+
+    def close(self):
+        """
+        :return: the dataset "volume", opened read-only. The caller owns its file and closes it
+        with closeVolume.
+        """
+        import h5py
+
+        self.h5File.close()
+        replaceOutput(self.temporaryFilename, self.outputFilename)
+        return h5py.File(self.outputFilename, "r")["volume"]
+
+    def abort(self):
+        self.h5File.close()
+        removeOutput(self.temporaryFilename)
+
+
+def closeVolume(volume):
+    """
+    Closes the file of a volume returned by the close() of a writer. Only HDF5 datasets keep
+    their file open, NIfTI images and Zarr arrays are read on access.
+    """
+    if hasattr(volume, "file") and hasattr(volume.file, "close"):
+        volume.file.close()
+
+
+def outputExtension(outputFormat):
+    if outputFormat not in OUTPUT_FORMATS:
+        raise ValueError("Unknown output format " + outputFormat + ", expected one of " +
+                         ", ".join(sorted(OUTPUT_FORMATS)) + ".")
+    return OUTPUT_FORMATS[outputFormat]
+
+
+def createVolumeWriter(outputFilename, shape, affine, numThreads=None):
+    """
+    Chooses the writer from the extension of outputFilename.
+    :param shape: the shape of the volume, slices are written along its last axis.
+    :param affine: the 4x4 voxel to mm affine.
+    :param numThreads: the number of compression threads of .nii.gz output.
+    :return: a writer with writeSlice(sliceIndex, volumeSlice), close() and abort(), where
+    volumeSlice is a shape[1] x shape[0] array holding the voxels (x, y) of the slice at [y, x],
+    close moves the complete volume to outputFilename and returns it, opened lazily, and abort
+    removes the partial volume. The HDF5 dataset returned by close keeps its file open, the
+    caller closes it with closeVolume.
+    """
+    if outputFilename.endswith(".nii") or outputFilename.endswith(".nii.gz"):
+        return NiftiWriter(outputFilename, shape, affine, numThreads)
+    if outputFilename.endswith(".zarr"):
+        return ZarrWriter(outputFilename, shape, affine, numThreads)
+    if outputFilename.endswith(".h5") or outputFilename.endswith(".hdf5"):
+        return Hdf5Writer(outputFilename, shape, affine, numThreads)
+    raise ValueError("Unknown output format of " + outputFilename + ".")
@@ -0,0 +1,99 @@
+#
+# Reads the members of the zip archives exported from the Zeiss Cirrus OCT machine
+# in place, without extracting them to a temporary directory.
+#
+
+import mmap
+import struct
+import zipfile
+
+# Size of the fixed part of a zip local file header, see the zip APPNOTE, section 4.3.7
+LOCAL_HEADER_SIZE = 30
+
+
+class ZipMember:
+    """
+    Reference to a single member of a zip archive.
+    """
+    def __init__(self, zipFileObject, zipInfo):
+        self.zipFileObject = zipFileObject
+        self.zipInfo = zipInfo
+
+    @property
+    def archive(self):
+        return self.zipFileObject.filename
+
+    @property
+    def name(self):
+        return self.zipInfo.filename
+
+    @property
+    def size(self):
+        """
+        The uncompressed size of the member in bytes.
+        """
+        return self.zipInfo.file_size
+
+    @property
+    def isStored(self):
+        return self.zipInfo.compress_type == zipfile.ZIP_STORED and not self.zipInfo.flag_bits & 0x1
+
+    def open(self):
+        """
+        :return: a file object that decompresses the member as it is read.
+        """
+        return self.zipFileObject.open(self.zipInfo)
+
+    def read(self):
+        """
+        Reads the whole member. Members stored without compression are not copied: the
+        returned memoryview points straight into a read-only mmap of the archive.
+        :return: a bytes-like object with the content of the member.
+        """
+        if not self.isStored:
+            return self.zipFileObject.read(self.zipInfo)
+
+        with open(self.archive, "rb") as f:
+            archiveMap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # The local header repeats the filename and may carry a different extra field
+        headerOffset = self.zipInfo.header_offset
+        filenameLength, extraLength = struct.unpack(
+            "<HH", archiveMap[headerOffset + 26:headerOffset + LOCAL_HEADER_SIZE])
+        dataOffset = headerOffset + LOCAL_HEADER_SIZE + filenameLength + extraLength
+        return memoryview(archiveMap)[dataOffset:dataOffset + self.zipInfo.file_size]
+
+    def iterateChunks(self, chunkSize):
+        """
+        Reads the member chunk by chunk, so that memory stays bounded by chunkSize.
+        Chunks of members stored without compression are views into the mmap of the archive,
+        compressed members are decompressed as they are read.
+        :return: an iterator of bytes-like objects of chunkSize bytes, the last one may be shorter.
+        """
+        if self.isStored:
+            data = self.read()
+            for offset in range(0, len(data), chunkSize):
+                yield data[offset:offset + chunkSize]
+            return
+
+        with self.open() as memberFile:
+            while True:
+                chunk = memberFile.read(chunkSize)
+                if not chunk:
+                    return
+                yield chunk
+
+    def __repr__(self):
+        return self.archive + ":" + self.name
+
+
+def listZipMembers(zipFilename, nameFilter=None):
+    """
+    Lists the members of a zip archive from its central directory, without reading them.
+    :param zipFilename: the path of the zip archive.
+    :param nameFilter: a function that receives a member name and returns whether to keep it.
+    :return: a list of ZipMember, sharing one open archive.
+    """
+    zipFileObject = zipfile.ZipFile(zipFilename)
+    return [ZipMember(zipFileObject, zipInfo) for zipInfo in zipFileObject.infolist()
+            if not zipInfo.is_dir() and (nameFilter is None or nameFilter(zipInfo.filename))]
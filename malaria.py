@@ -1,114 +1,166 @@
 import numpy as np
-import cv2
-import os
 import matplotlib.pyplot as plt
-from PIL import Image
 from keras.models import Sequential, load_model
 from keras.layers import Dense, Dropout, Flatten, Conv2D, MaxPool2D, BatchNormalization
-from sklearn.model_selection import train_test_split
 from keras.utils import to_categorical
-
-np.random.seed(1000)
+from keras.callbacks import BackupAndRestore
+from keras import mixed_precision
+from malaria_loader import load_dataset, list_images
+from malaria_dataset import split_indices
+from malaria_pipeline import cached_pipeline, file_pipeline
+from malaria_profiling import StageProfiler, TelemetryCallback
 
 # Resize Images
 image_directory= 'cell_images/cell_images_small/'
 SIZE=64
-x_images=[]
-label=[]
-
-parasitized_images=os.listdir(image_directory+ 'Parasitized/')
-for i,image_name in enumerate(parasitized_images):
-    if(image_name.split('.')[1]=='png'):
-        image=cv2.imread(image_directory+'Parasitized/'+image_name)
-        image=Image.fromarray(image,'RGB')
-        image=image.resize((SIZE,SIZE))
-        x_images.append(np.array(image))
-        label.append(0)
-
-uninfected_images=os.listdir(image_directory+ 'Uninfected/')
-for i,image_name in enumerate(uninfected_images):
-    if(image_name.split('.')[1]=='png'):
-        image=cv2.imread(image_directory+'Uninfected/'+image_name)
-        image=Image.fromarray(image,'RGB')
-        image=image.resize((SIZE,SIZE))
-        x_images.append(np.array(image))
-        label.append(1)
-
-
-# Create the Model
-model=Sequential()
-model.add(Conv2D(32,(3,3),input_shape=(64,64,3),padding='same',activation = 'relu'))
-model.add(MaxPool2D(pool_size=(2,2)))
-model.add(BatchNormalization())
-model.add(Dropout(0.2))
-
-
-model.add(Conv2D(64,(3,3),padding='same',activation = 'relu'))
-model.add(MaxPool2D(pool_size=(2,2)))
-model.add(BatchNormalization())
-model.add(Dropout(0.2))
-
-model.add(Conv2D(128,(3,3),padding='same',activation = 'relu'))
-model.add(MaxPool2D(pool_size=(2,2)))
-model.add(BatchNormalization())
-model.add(Dropout(0.2))
-
-model.add(Flatten())
-model.add(Dense(512,activation='relu'))
-model.add(BatchNormalization())
-model.add(Dropout(0.2))
-model.add(Dense(256,activation='relu'))
-model.add(BatchNormalization())
-model.add(Dropout(0.2))
-model.add(Dense(2,activation='sigmoid'))
-
-model.summary()
-model.compile(optimizer='Adam', loss='categorical_crossentropy', metrics=['accuracy'])
-
-
-# Split the train set
-X_train, X_test, y_train, y_test = train_test_split(x_images,to_categorical(np.array(label)),test_size=0.20,random_state=0)
-
-
-
-#for x, y in  zip(X_test, y_test):
-#    plt.imshow(x)
-#    plt.show()
-#    print (y)
-
-# Training and Save Model
-
-history=model.fit(np.array(X_train),y_train, batch_size=64,verbose=1,epochs=25,  validation_data=(np.array(X_test), y_test))
-model.save('malaria_cnn.h5')
-print("Test_Accuracy: {:.2f}%".format(model.evaluate(np.array(X_test), np.array(y_test))[1]*100))
-
-score = model.evaluate(np.array(X_test), np.array(y_test))
-print('Test loss:', score[0])
-print('Test accuracy:', score[1])
-
-f, (ax1, ax2) = plt.subplots(1, 2, figsize=(12, 4))
-t = f.suptitle('CNN Performance', fontsize=12)
-f.subplots_adjust(top=0.85, wspace=0.3)
-
-# summarize history for accuracy
-max_epoch = len(history.history['accuracy'])+1
-epoch_list = list(range(1,max_epoch))
-ax1.plot(epoch_list, history.history['accuracy'], label='Train Accuracy')
-ax1.plot(epoch_list, history.history['val_accuracy'], label='Validation Accuracy')
-ax1.set_xticks(np.arange(1, max_epoch, 5))
-ax1.set_ylabel('Accuracy Value')
-ax1.set_xlabel('Epoch')
-ax1.set_title('Accuracy')
-l1 = ax1.legend(loc="best")
-
-# summarize history for loss
-ax2.plot(epoch_list, history.history['loss'], label='Train Loss')
-ax2.plot(epoch_list, history.history['val_loss'], label='Validation Loss')
-ax2.set_xticks(np.arange(1, max_epoch, 5))
-ax2.set_ylabel('Loss Value')
-ax2.set_xlabel('Epoch')
-ax2.set_title('Loss')
-l2 = ax2.legend(loc="best")
-
-
-plt.show()
+
+# 'cache' decodes all images once into a memory-mapped dataset and streams batches from it,
+# 'files' streams and decodes the png files on every epoch, so nothing is cached on disk
+INPUT_MODE='cache'
+BATCH_SIZE=64
+EPOCHS=25
+# Stage timings, memory high-water marks and per-batch telemetry are written to this trace
+TRACE_FILE='malaria_trace.json'
+# bfloat16 mixed precision and XLA compilation of the training step
+MIXED_PRECISION=False
+JIT_COMPILE=False
+# The training state is backed up here after every epoch, an interrupted run resumes from the last backup
+CHECKPOINT_DIRECTORY='malaria_checkpoints'
+
+
+def set_mixed_precision(enabled):
+    # Layers created afterwards compute in bfloat16 and keep float32 weights
+    mixed_precision.set_global_policy('mixed_bfloat16' if enabled else 'float32')
+
+
+def build_model(size=SIZE, jit_compile=JIT_COMPILE, dropout=0.2, filters=(32, 64, 128)):
+    # Create the Model
+    model=Sequential()
+    model.add(Conv2D(filters[0],(3,3),input_shape=(size,size,3),padding='same',activation = 'relu'))
+    model.add(MaxPool2D(pool_size=(2,2)))
+    model.add(BatchNormalization())
+    model.add(Dropout(dropout))
+
+
+    model.add(Conv2D(filters[1],(3,3),padding='same',activation = 'relu'))
+    model.add(MaxPool2D(pool_size=(2,2)))
+    model.add(BatchNormalization())
+    model.add(Dropout(dropout))
+
+    model.add(Conv2D(filters[2],(3,3),padding='same',activation = 'relu'))
+    model.add(MaxPool2D(pool_size=(2,2)))
+    model.add(BatchNormalization())
+    model.add(Dropout(dropout))
+
+    model.add(Flatten())
+    model.add(Dense(512,activation='relu'))
+    model.add(BatchNormalization())
+    model.add(Dropout(dropout))
+    model.add(Dense(256,activation='relu'))
+    model.add(BatchNormalization())
+    model.add(Dropout(dropout))
+    # The output stays float32 under mixed precision for a numerically stable loss
+    model.add(Dense(2,activation='sigmoid',dtype='float32'))
+
+    model.compile(optimizer='Adam', loss='categorical_crossentropy', metrics=['accuracy'], jit_compile=jit_compile)
+    return model
+
+
+def load_training_data(image_directory, size=SIZE, input_mode=INPUT_MODE, batch_size=BATCH_SIZE, profiler=None):
+    """
+    Loads the images, splits them into train and test set and builds the input pipelines.
+    :param profiler: a StageProfiler that times the loading and the split.
+    :return: the train and test tf.data pipelines.
+    """
+    if profiler is None:
+        profiler = StageProfiler()
+
+    with profiler.stage('load_images', input_mode=input_mode):
+        if input_mode=='cache':
+            # Decoding and resizing run in a process pool, the result is cached per image path, mtime and SIZE
+            # into a memory-mapped uint8 dataset, so x_images is a np.memmap and nothing is copied into RAM
+            x_images, label = load_dataset(image_directory, size, cache_directory='malaria_images_{}'.format(size))
+        else:
+            image_paths, label = list_images(image_directory)
+
+    # Split the train set
+    # The splits are index arrays into the images, the same rows train_test_split selected before
+    with profiler.stage('split'):
+        train_indices, test_indices = split_indices(len(label), test_size=0.20, random_state=0)
+    y_images = to_categorical(np.array(label))
+    if input_mode=='cache':
+        train_data = cached_pipeline(x_images, y_images, train_indices, batch_size=batch_size, shuffle=True)
+        test_data = cached_pipeline(x_images, y_images, test_indices, batch_size=batch_size)
+    else:
+        image_paths = np.array(image_paths)
+        train_data = file_pipeline(image_paths[train_indices], y_images[train_indices], size, batch_size=batch_size,
+                                   shuffle=True)
+        test_data = file_pipeline(image_paths[test_indices], y_images[test_indices], size, batch_size=batch_size)
+    return train_data, test_data
+
+
+def plot_history(history):
+    f, (ax1, ax2) = plt.subplots(1, 2, figsize=(12, 4))
+    t = f.suptitle('CNN Performance', fontsize=12)
+    f.subplots_adjust(top=0.85, wspace=0.3)
+
+    # summarize history for accuracy
+    max_epoch = len(history.history['accuracy'])+1
+    epoch_list = list(range(1,max_epoch))
+    ax1.plot(epoch_list, history.history['accuracy'], label='Train Accuracy')
+    ax1.plot(epoch_list, history.history['val_accuracy'], label='Validation Accuracy')
+    ax1.set_xticks(np.arange(1, max_epoch, 5))
+    ax1.set_ylabel('Accuracy Value')
+    ax1.set_xlabel('Epoch')
+    ax1.set_title('Accuracy')
+    l1 = ax1.legend(loc="best")
+
+    # summarize history for loss
+    ax2.plot(epoch_list, history.history['loss'], label='Train Loss')
+    ax2.plot(epoch_list, history.history['val_loss'], label='Validation Loss')
+    ax2.set_xticks(np.arange(1, max_epoch, 5))
+    ax2.set_ylabel('Loss Value')
+    ax2.set_xlabel('Epoch')
+    ax2.set_title('Loss')
+    l2 = ax2.legend(loc="best")
+
+
+    plt.show()
+
+
+if __name__ == "__main__":
+
+    np.random.seed(1000)
+
+    profiler = StageProfiler()
+    train_data, test_data = load_training_data(image_directory, SIZE, INPUT_MODE, BATCH_SIZE, profiler)
+
+    set_mixed_precision(MIXED_PRECISION)
+    model = build_model(SIZE, JIT_COMPILE)
+    model.summary()
+
+
+    #for x, y in  test_data.unbatch():
+    #    plt.imshow(x)
+    #    plt.show()
+    #    print (y)
+
+    # Training and Save Model
+
+    # The telemetry times the data wait of every batch at the end of the training pipeline
+    telemetry = TelemetryCallback(profiler, BATCH_SIZE)
+    with profiler.stage('fit', epochs=EPOCHS, mixed_precision=MIXED_PRECISION, jit_compile=JIT_COMPILE):
+        history=model.fit(telemetry.instrument(train_data),verbose=1,epochs=EPOCHS,  validation_data=test_data,
+                          callbacks=[telemetry, BackupAndRestore(CHECKPOINT_DIRECTORY)])
+    model.save('malaria_cnn.h5')
+
+    with profiler.stage('evaluate'):
+        score = model.evaluate(test_data)
+    print("Test_Accuracy: {:.2f}%".format(score[1]*100))
+    print('Test loss:', score[0])
+    print('Test accuracy:', score[1])
+
+    profiler.summary()
+    profiler.save(TRACE_FILE)
+
+    plot_history(history)
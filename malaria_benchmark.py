@@ -0,0 +1,235 @@
+#
+# Reproducible benchmark of the malaria.py stages on synthetic cell images, so that
+# no NIH download is needed. Every stage is timed separately and the results are
+# written to JSON to track regressions across changes.
+#
+
+import os, sys, getopt
+import json
+import platform
+import shutil
+import tempfile
+import time
+import numpy as np
+import cv2
+from PIL import Image
+from malaria_loader import CLASS_DIRECTORIES, list_images, load_dataset
+
+
+def generate_synthetic_images(image_directory, num_per_class, seed=0):
+    """
+    Writes num_per_class png images into every class directory. Images are stained
+    cell-like discs of varying size on a black background, parasitized cells carry a
+    few dark purple inclusions.
+    """
+    rng = np.random.RandomState(seed)
+    for class_directory, class_label in CLASS_DIRECTORIES:
+        directory = os.path.join(image_directory, class_directory)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        for idx in range(num_per_class):
+            height, width = rng.randint(100, 200, size=2)
+            image = np.zeros((height, width, 3), dtype=np.uint8)
+            center = (width // 2, height // 2)
+            axes = (width // 2 - rng.randint(2, 10), height // 2 - rng.randint(2, 10))
+            color = tuple(int(value) for value in rng.randint(150, 230, size=3))
+            cv2.ellipse(image, center, axes, 0, 0, 360, color, -1)
+            if class_label == 0:
+                for spot in range(rng.randint(1, 4)):
+                    spot_center = (int(center[0] + rng.randint(-axes[0] // 2, axes[0] // 2 + 1)),
+                                   int(center[1] + rng.randint(-axes[1] // 2, axes[1] // 2 + 1)))
+                    cv2.circle(image, spot_center, int(rng.randint(3, 8)), (120, 40, 90), -1)
+            noise = rng.randint(0, 12, size=image.shape).astype(np.uint8)
+            cv2.imwrite(os.path.join(directory, 'synthetic_{}.png'.format(idx)), cv2.add(image, noise))
+
+
+def timed(results, name, function, *args, **kwargs):
+    """
+    Runs function and records its wall time in seconds in results[name].
+    """
+    start = time.perf_counter()
+    value = function(*args, **kwargs)
+    results[name] = time.perf_counter() - start
+    return value
+
+
+def benchmark_ingestion(image_directory, size, work_directory, workers=None):
+    """
+    Times the ingestion stages of malaria.py: listing, decoding, resizing and splitting,
+    and the cached process-pool loader both cold and warm.
+    """
+    from malaria_dataset import split_indices
+    from sklearn.model_selection import train_test_split
+
+    results = {}
+    image_paths, labels = timed(results, 'list_seconds', list_images, image_directory)
+    decoded = timed(results, 'decode_seconds', lambda: [cv2.imread(image_path) for image_path in image_paths])
+    resized = timed(results, 'resize_seconds',
+                    lambda: [np.array(Image.fromarray(image, 'RGB').resize((size, size))) for image in decoded])
+    timed(results, 'split_list_seconds', train_test_split, resized, labels, test_size=0.20, random_state=0)
+    timed(results, 'split_indices_seconds', split_indices, len(labels), test_size=0.20, random_state=0)
+
+    cache_directory = os.path.join(work_directory, 'malaria_images_{}'.format(size))
+    timed(results, 'load_dataset_cold_seconds', load_dataset, image_directory, size, cache_directory, workers)
+    timed(results, 'load_dataset_warm_seconds', load_dataset, image_directory, size, cache_directory, workers)
+    results['num_images'] = len(image_paths)
+    return results
+
+
+def benchmark_training(image_directory, size, epochs, batch_size, mixed_precision=False, jit_compile=False):
+    """
+    Times model.fit of the malaria.py model epoch by epoch.
+    :param mixed_precision: trains with bfloat16 mixed precision.
+    :param jit_compile: compiles the training step with XLA.
+    """
+    from keras.callbacks import Callback
+    from malaria import build_model, load_training_data, set_mixed_precision
+
+    class EpochTimer(Callback):
+        def on_train_begin(self, logs=None):
+            self.epoch_seconds = []
+
+        def on_epoch_begin(self, epoch, logs=None):
+            self.start = time.perf_counter()
+            self.steps = 0
+
+        def on_train_batch_end(self, batch, logs=None):
+            self.steps += 1
+
+        def on_epoch_end(self, epoch, logs=None):
+            self.epoch_seconds.append(time.perf_counter() - self.start)
+
+    np.random.seed(1000)
+    train_data, test_data = load_training_data(image_directory, size, 'cache', batch_size)
+    set_mixed_precision(mixed_precision)
+    try:
+        model = build_model(size, jit_compile)
+    finally:
+        set_mixed_precision(False)
+    timer = EpochTimer()
+    model.fit(train_data, verbose=0, epochs=epochs, callbacks=[timer])
+    # The first epoch includes graph tracing and XLA compilation
+    steady_epoch_seconds = float(np.median(timer.epoch_seconds[1:] or timer.epoch_seconds))
+    return model, {'epoch_seconds': timer.epoch_seconds, 'steady_epoch_seconds': steady_epoch_seconds,
+                   'step_ms': steady_epoch_seconds / timer.steps * 1000}
+
+
+def benchmark_training_modes(image_directory, size, epochs, batch_size):
+    """
+    Compares the step time of bfloat16 mixed precision and XLA against the float32 baseline.
+    """
+    results = {}
+    for name, mixed_precision, jit_compile in [('float32', False, False), ('mixed_bfloat16', True, False),
+                                               ('float32_xla', False, True), ('mixed_bfloat16_xla', True, True)]:
+        model, results[name] = benchmark_training(image_directory, size, epochs, batch_size, mixed_precision,
+                                                  jit_compile)
+        results[name]['speedup'] = results['float32']['step_ms'] / results[name]['step_ms']
+    return results
+
+
+def benchmark_predict(model, size, batch_sizes, num_images=1024, repeats=3):
+    """
+    Times predict_on_batch on random images at several batch sizes.
+    """
+    rng = np.random.RandomState(0)
+    images = rng.randint(0, 256, size=(num_images, size, size, 3)).astype(np.uint8)
+    results = {}
+    for batch_size in batch_sizes:
+        model.predict_on_batch(images[:batch_size])
+        latencies = []
+        for repeat in range(repeats):
+            for position in range(0, num_images - batch_size + 1, batch_size):
+                start = time.perf_counter()
+                model.predict_on_batch(images[position:position + batch_size])
+                latencies.append(time.perf_counter() - start)
+        latencies = np.asarray(latencies)
+        results[str(batch_size)] = {'images_per_sec': batch_size * len(latencies) / float(latencies.sum()),
+                                    'p50_ms': float(np.percentile(latencies, 50) * 1000),
+                                    'p99_ms': float(np.percentile(latencies, 99) * 1000)}
+    return results
+
+
+def run_benchmark(num_per_class=500, size=64, epochs=2, batch_size=64, predict_batch_sizes=(1, 32, 256, 1024),
+                  work_directory=None, workers=None, training_modes=False):
+    """
+    Generates the synthetic images and runs every benchmark stage.
+    :param training_modes: also compares mixed precision and XLA training against the baseline.
+    :return: a JSON-serializable dictionary of the results.
+    """
+    remove_work_directory = work_directory is None
+    if work_directory is None:
+        work_directory = tempfile.mkdtemp(prefix='malaria_benchmark_')
+    image_directory = os.path.join(work_directory, 'images') + '/'
+
+    # The cache directory of load_training_data is relative to the working directory
+    current_directory = os.getcwd()
+    os.chdir(work_directory)
+    try:
+        results = {
+            'config': {'num_per_class': num_per_class, 'size': size, 'epochs': epochs, 'batch_size': batch_size},
+            'environment': {'python': platform.python_version(), 'numpy': np.__version__,
+                            'platform': platform.platform(), 'cpus': os.cpu_count()},
+        }
+        timed(results, 'generate_seconds', generate_synthetic_images, image_directory, num_per_class)
+        results['ingestion'] = benchmark_ingestion(image_directory, size, work_directory, workers)
+        model, results['training'] = benchmark_training(image_directory, size, epochs, batch_size)
+        results['predict'] = benchmark_predict(model, size, predict_batch_sizes)
+        if training_modes:
+            results['training_modes'] = benchmark_training_modes(image_directory, size, epochs, batch_size)
+    finally:
+        os.chdir(current_directory)
+        if remove_work_directory:
+            shutil.rmtree(work_directory, ignore_errors=True)
+    return results
+
+
+def help():
+    print("malaria_benchmark.py [-n <imagesperclass>] [-s <size>] [-e <epochs>] [-b <batchsize>] "
+          "[-w <workers>] [-d <workdirectory>] [-o <results.json>] [-m]")
+
+
+if __name__ == "__main__":
+
+    num_per_class = 500
+    size = 64
+    epochs = 2
+    batch_size = 64
+    workers = None
+    work_directory = None
+    output_file = 'benchmark_results.json'
+    training_modes = False
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hn:s:e:b:w:d:o:m",
+                                   ["imagesperclass=", "size=", "epochs=", "batchsize=", "workers=",
+                                    "workdirectory=", "output=", "trainingmodes"])
+    except getopt.GetoptError:
+        help()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            help()
+            sys.exit()
+        elif opt in ("-n", "--imagesperclass"):
+            num_per_class = int(arg)
+        elif opt in ("-s", "--size"):
+            size = int(arg)
+        elif opt in ("-e", "--epochs"):
+            epochs = int(arg)
+        elif opt in ("-b", "--batchsize"):
+            batch_size = int(arg)
+        elif opt in ("-w", "--workers"):
+            workers = int(arg)
+        elif opt in ("-d", "--workdirectory"):
+            work_directory = os.path.abspath(arg)
+        elif opt in ("-o", "--output"):
+            output_file = arg
+        elif opt in ("-m", "--trainingmodes"):
+            training_modes = True
+
+    output_file = os.path.abspath(output_file)
+    results = run_benchmark(num_per_class, size, epochs, batch_size, work_directory=work_directory, workers=workers,
+                            training_modes=training_modes)
+    with open(output_file, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+    print("Benchmark results saved at " + output_file)
@@ -0,0 +1,76 @@
+import os
+import shutil
+import numpy as np
+from numpy.lib.format import open_memmap
+from sklearn.model_selection import train_test_split
+
+# A dataset is a directory holding one contiguous uint8 N x SIZE x SIZE x 3 tensor and
+# the per-image arrays below, all in .npy format so they open as np.memmap without copying.
+IMAGES_FILE = 'images.npy'
+LABELS_FILE = 'labels.npy'
+PATHS_FILE = 'paths.npy'
+MTIMES_FILE = 'mtimes.npy'
+
+
+def create_dataset(dataset_directory, num_images, size):
+    """
+    Creates an empty dataset and returns its writable image memmap, which the caller
+    fills image by image before calling write_index.
+    :param dataset_directory: the directory to create.
+    :param num_images: the number of images N.
+    :param size: the width and height of the images.
+    :return: a writable uint8 memmap of N x size x size x 3.
+    """
+    if not os.path.exists(dataset_directory):
+        os.makedirs(dataset_directory)
+    return open_memmap(os.path.join(dataset_directory, IMAGES_FILE), mode='w+', dtype=np.uint8,
+                       shape=(num_images, size, size, 3))
+
+
+def write_index(dataset_directory, labels, image_paths, mtimes):
+    """
+    Writes the labels and the source path and mtime of every image of a dataset.
+    """
+    np.save(os.path.join(dataset_directory, LABELS_FILE), np.asarray(labels, dtype=np.uint8))
+    np.save(os.path.join(dataset_directory, PATHS_FILE), np.asarray(image_paths, dtype=np.str_))
+    np.save(os.path.join(dataset_directory, MTIMES_FILE), np.asarray(mtimes, dtype=np.int64))
+
+
+def open_dataset(dataset_directory):
+    """
+    Opens a dataset read-only. Nothing is read from disk until images are accessed.
+    :return: a uint8 memmap of N x SIZE x SIZE x 3 images and an array of N labels.
+    """
+    images = np.load(os.path.join(dataset_directory, IMAGES_FILE), mmap_mode='r')
+    labels = np.load(os.path.join(dataset_directory, LABELS_FILE))
+    return images, labels
+
+
+def open_index(dataset_directory):
+    """
+    :return: the source paths and mtimes of the images of a dataset.
+    """
+    image_paths = np.load(os.path.join(dataset_directory, PATHS_FILE))
+    mtimes = np.load(os.path.join(dataset_directory, MTIMES_FILE))
+    return image_paths, mtimes
+
+
+def replace_dataset(new_directory, dataset_directory):
+    """
+    Moves a completely written dataset in place of dataset_directory, so that readers
+    never see a partially written dataset.
+    """
+    old_directory = dataset_directory + '.old'
+    shutil.rmtree(old_directory, ignore_errors=True)
+    if os.path.exists(dataset_directory):
+        os.rename(dataset_directory, old_directory)
+    os.rename(new_directory, dataset_directory)
+    shutil.rmtree(old_directory, ignore_errors=True)
+
+
+def split_indices(num_images, test_size=0.20, random_state=0):
+    """
+    Splits a dataset into train and test index arrays. The indices are the same rows
+    train_test_split selects when it is given the images themselves.
+    """
+    return train_test_split(np.arange(num_images), test_size=test_size, random_state=random_state)
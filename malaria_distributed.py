@@ -0,0 +1,179 @@
+#
+# Opt-in data-parallel training of the malaria CNN across local worker processes with
+# tf.distribute.MultiWorkerMirroredStrategy. The launcher builds the image cache once,
+# then starts one worker process per shard. Every worker trains on its own shard of the
+# train indices, gradients are averaged across workers after every step, and the chief
+# saves malaria_cnn.h5 in the same format as the single-process run of malaria.py.
+#
+
+import os, sys, getopt
+import json
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+import numpy as np
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def launch_workers(num_workers, image_directory, size, epochs, batch_size, model_file):
+    """
+    Starts num_workers local worker processes and waits for them to finish. A failed worker
+    would block the collective ops of the others, so they are terminated once any worker
+    exits with an error.
+    :return: the exit codes of the workers, negative for terminated workers.
+    """
+    # Decode once in the launcher, so that the workers only open the memory-mapped cache
+    from malaria_loader import load_dataset
+    cache_directory = 'malaria_images_{}'.format(size)
+    load_dataset(image_directory, size, cache_directory=cache_directory)
+
+    cluster = {'worker': ['127.0.0.1:{}'.format(_free_port()) for worker in range(num_workers)]}
+    threads_per_worker = max(1, (os.cpu_count() or 1) // num_workers)
+    processes = []
+    for worker in range(num_workers):
+        env = dict(os.environ)
+        env['TF_CONFIG'] = json.dumps({'cluster': cluster, 'task': {'type': 'worker', 'index': worker}})
+        # Split the cores between the workers instead of letting every worker use all of them
+        env['TF_NUM_INTRAOP_THREADS'] = str(threads_per_worker)
+        env['OMP_NUM_THREADS'] = str(threads_per_worker)
+        processes.append(subprocess.Popen([sys.executable, os.path.abspath(__file__), '--worker',
+                                           '-c', cache_directory, '-e', str(epochs), '-b', str(batch_size),
+                                           '-o', model_file], env=env))
+    return wait_workers(processes)
+
+
+def wait_workers(processes, poll_interval=1.0):
+    """
+    Polls all processes until they have exited, and terminates the others once one of them fails.
+    :return: the exit codes of the processes.
+    """
+    while True:
+        exit_codes = [process.poll() for process in processes]
+        if all(exit_code is not None for exit_code in exit_codes):
+            break
+        if any(exit_codes):
+            for process, exit_code in zip(processes, exit_codes):
+                if exit_code is None:
+                    process.terminate()
+            for process in processes:
+                try:
+                    process.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+            break
+        time.sleep(poll_interval)
+    return [process.wait() for process in processes]
+
+
+def train_worker(cache_directory, epochs, batch_size, model_file):
+    """
+    Runs one worker of the cluster described by TF_CONFIG.
+    :param batch_size: the global batch size, split evenly between the workers, so
+    that the optimization matches the single-process run.
+    """
+    import tensorflow as tf
+
+    # The strategy has to be created before any other TensorFlow operation
+    strategy = tf.distribute.MultiWorkerMirroredStrategy()
+    from keras.utils import to_categorical
+    from malaria import build_model
+    from malaria_dataset import open_dataset, split_indices
+    from malaria_pipeline import cached_pipeline
+
+    np.random.seed(1000)
+    tf.random.set_seed(1000)
+
+    x_images, label = open_dataset(cache_directory)
+    size = x_images.shape[1]
+    train_indices, test_indices = split_indices(len(label), test_size=0.20, random_state=0)
+    y_images = to_categorical(np.array(label))
+
+    def dataset_function(indices, shuffle):
+        def create(input_context):
+            # Every worker reads only its own shard of the indices
+            shard = indices[input_context.input_pipeline_id::input_context.num_input_pipelines]
+            per_worker_batch_size = input_context.get_per_replica_batch_size(batch_size)
+            return cached_pipeline(x_images, y_images, shard, batch_size=per_worker_batch_size,
+                                   shuffle=shuffle).repeat()
+        return tf.keras.utils.experimental.DatasetCreator(create)
+
+    with strategy.scope():
+        model = build_model(size)
+
+    model.fit(dataset_function(train_indices, True), epochs=epochs,
+              steps_per_epoch=len(train_indices) // batch_size,
+              validation_data=dataset_function(test_indices, False),
+              validation_steps=len(test_indices) // batch_size, verbose=2)
+
+    # Every worker has to take part in saving, only the chief writes to model_file
+    task = json.loads(os.environ['TF_CONFIG'])['task']
+    if task['index'] == 0:
+        model.save(model_file)
+        print("Model saved at " + model_file)
+    else:
+        # The copies of the other workers are discarded
+        worker_directory = tempfile.mkdtemp(prefix='malaria_worker_{}_'.format(task['index']))
+        try:
+            model.save(os.path.join(worker_directory, os.path.basename(model_file)))
+        finally:
+            shutil.rmtree(worker_directory, ignore_errors=True)
+
+
+def help():
+    print("malaria_distributed.py -n <numworkers> [-i <imagedirectory>] [-s <size>] [-e <epochs>] "
+          "[-b <globalbatchsize>] [-o <model.h5>]")
+
+
+if __name__ == "__main__":
+
+    from malaria import image_directory, SIZE, EPOCHS, BATCH_SIZE
+
+    num_workers = 2
+    size = SIZE
+    epochs = EPOCHS
+    batch_size = BATCH_SIZE
+    model_file = 'malaria_cnn.h5'
+    cache_directory = None
+    worker = False
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hn:i:s:e:b:o:c:",
+                                   ["numworkers=", "imagedirectory=", "size=", "epochs=", "batchsize=", "output=",
+                                    "cachedirectory=", "worker"])
+    except getopt.GetoptError:
+        help()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            help()
+            sys.exit()
+        elif opt in ("-n", "--numworkers"):
+            num_workers = int(arg)
+        elif opt in ("-i", "--imagedirectory"):
+            image_directory = arg
+        elif opt in ("-s", "--size"):
+            size = int(arg)
+        elif opt in ("-e", "--epochs"):
+            epochs = int(arg)
+        elif opt in ("-b", "--batchsize"):
+            batch_size = int(arg)
+        elif opt in ("-o", "--output"):
+            model_file = arg
+        elif opt in ("-c", "--cachedirectory"):
+            cache_directory = arg
+        elif opt == "--worker":
+            worker = True
+
+    if worker:
+        train_worker(cache_directory, epochs, batch_size, model_file)
+    else:
+        exit_codes = launch_workers(num_workers, image_directory, size, epochs, batch_size, model_file)
+        if any(exit_codes):
+            print("Error - workers exited with " + str(exit_codes))
+            sys.exit(1)
@@ -0,0 +1,172 @@
+#
+# Converts the trained malaria CNN (malaria_cnn.h5) to TFLite, optionally with
+# post-training int8 quantization, and compares the converted model against the
+# original on the held-out split.
+#
+# TFLiteModel runs a converted model with tflite_runtime when it is installed, so
+# scoring hosts do not need to import the full TensorFlow/keras stack.
+#
+
+import sys, getopt
+import json
+import time
+import numpy as np
+
+
+class TFLiteModel:
+    """
+    Runs a .tflite model with the predict_on_batch interface of a keras model, so it
+    can replace one in malaria_predict and malaria_server.
+    """
+    def __init__(self, model_file, num_threads=None):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            from tensorflow.lite import Interpreter
+        self.interpreter = Interpreter(model_path=model_file, num_threads=num_threads)
+        self.input_details = self.interpreter.get_input_details()[0]
+        self.output_details = self.interpreter.get_output_details()[0]
+        self.input_shape = tuple(int(dim) for dim in self.input_details['shape'])
+        self.batch_size = None
+
+    def predict_on_batch(self, images):
+        if self.batch_size != len(images):
+            self.interpreter.resize_tensor_input(self.input_details['index'], (len(images),) + self.input_shape[1:])
+            self.interpreter.allocate_tensors()
+            self.batch_size = len(images)
+
+        # Quantized models take integer inputs, see the quantization parameters of the converter
+        dtype = self.input_details['dtype']
+        if np.issubdtype(dtype, np.integer):
+            scale, zero_point = self.input_details['quantization']
+            info = np.iinfo(dtype)
+            images = np.clip(np.round(images / scale + zero_point), info.min, info.max).astype(dtype)
+        else:
+            images = images.astype(dtype)
+        self.interpreter.set_tensor(self.input_details['index'], images)
+        self.interpreter.invoke()
+
+        probabilities = self.interpreter.get_tensor(self.output_details['index'])
+        if np.issubdtype(self.output_details['dtype'], np.integer):
+            scale, zero_point = self.output_details['quantization']
+            probabilities = (probabilities.astype(np.float32) - zero_point) * scale
+        return probabilities
+
+
+def load_inference_model(model_file):
+    """
+    Loads a .tflite model with TFLiteModel and anything else with keras.
+    """
+    if model_file.endswith('.tflite'):
+        return TFLiteModel(model_file)
+    from keras.models import load_model
+    return load_model(model_file)
+
+
+def export_tflite(model_file, output_file, calibration_images=None):
+    """
+    Converts a keras model to TFLite.
+    :param model_file: the keras .h5 model.
+    :param output_file: the .tflite file to write.
+    :param calibration_images: a sample of training images. When given, weights and
+    activations are quantized to int8 with ranges calibrated on these images.
+    """
+    import tensorflow as tf
+    from keras.models import load_model
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(load_model(model_file))
+    if calibration_images is not None:
+        def representative_dataset():
+            for image in calibration_images:
+                yield [np.asarray(image, dtype=np.float32)[np.newaxis]]
+
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        # The network takes raw 0-255 pixel values, so uint8 inputs are exact
+        converter.inference_input_type = tf.uint8
+
+    with open(output_file, 'wb') as f:
+        f.write(converter.convert())
+    print("TFLite model saved at " + output_file)
+
+
+def evaluate_model(model, images, labels, batch_size=256):
+    """
+    :return: the accuracy of model on images and its throughput in images/sec.
+    """
+    correct = 0
+    start = time.perf_counter()
+    for position in range(0, len(labels), batch_size):
+        probabilities = model.predict_on_batch(np.asarray(images[position:position + batch_size]))
+        correct += int(np.sum(np.argmax(probabilities, axis=1) == labels[position:position + batch_size]))
+    elapsed = time.perf_counter() - start
+    return correct / len(labels), len(labels) / elapsed
+
+
+def compare_models(model_files, images, labels, batch_size=256):
+    """
+    Evaluates every model file on the same images.
+    :return: a dictionary with the accuracy and images/sec of every model file.
+    """
+    report = {}
+    for model_file in model_files:
+        accuracy, throughput = evaluate_model(load_inference_model(model_file), images, labels, batch_size)
+        report[model_file] = {'accuracy': accuracy, 'images_per_sec': throughput}
+        print("{}: accuracy = {:.2f}%, {:.1f} images/sec".format(model_file, accuracy * 100, throughput))
+    return report
+
+
+def help():
+    print("malaria_export.py -m <model.h5> -o <model.tflite> [-q] [-c <cachedirectory>] "
+          "[-n <calibrationimages>] [-r <report.json>]")
+
+
+if __name__ == "__main__":
+
+    model_file = 'malaria_cnn.h5'
+    output_file = 'malaria_cnn.tflite'
+    quantize = False
+    cache_directory = 'malaria_images_64'
+    num_calibration = 500
+    report_file = None
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hm:o:qc:n:r:",
+                                   ["model=", "output=", "quantize", "cachedirectory=", "calibration=", "report="])
+    except getopt.GetoptError:
+        help()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            help()
+            sys.exit()
+        elif opt in ("-m", "--model"):
+            model_file = arg
+        elif opt in ("-o", "--output"):
+            output_file = arg
+        elif opt in ("-q", "--quantize"):
+            quantize = True
+        elif opt in ("-c", "--cachedirectory"):
+            cache_directory = arg
+        elif opt in ("-n", "--calibration"):
+            num_calibration = int(arg)
+        elif opt in ("-r", "--report"):
+            report_file = arg
+
+    # Calibrate and compare on the cached dataset with the split of malaria.py
+    from malaria_dataset import open_dataset, split_indices
+    x_images, label = open_dataset(cache_directory)
+    train_indices, test_indices = split_indices(len(label), test_size=0.20, random_state=0)
+    test_indices = np.sort(test_indices)
+
+    calibration_images = None
+    if quantize:
+        rng = np.random.RandomState(0)
+        sample = np.sort(rng.choice(train_indices, min(num_calibration, len(train_indices)), replace=False))
+        calibration_images = x_images[sample]
+
+    export_tflite(model_file, output_file, calibration_images)
+    report = compare_models([model_file, output_file], x_images[test_indices], label[test_indices])
+    if report_file is not None:
+        with open(report_file, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,131 @@
+import os
+import shutil
+import numpy as np
+import cv2
+from PIL import Image
+from concurrent.futures import ProcessPoolExecutor
+from malaria_dataset import IMAGES_FILE, create_dataset, write_index, open_dataset, open_index, replace_dataset
+
+# Sub-directories of the image directory and the label given to their images
+CLASS_DIRECTORIES = [('Parasitized/', 0), ('Uninfected/', 1)]
+
+
+def list_images(image_directory):
+    """
+    Lists the png cell images of every class directory in the same order as
+    the original loading loops of malaria.py.
+    :param image_directory: the root directory containing the class directories.
+    :return: a list of image paths and a list of their labels.
+    """
+    image_paths = []
+    labels = []
+    for class_directory, class_label in CLASS_DIRECTORIES:
+        for image_name in os.listdir(image_directory + class_directory):
+            if(image_name.split('.')[1]=='png'):
+                image_paths.append(image_directory + class_directory + image_name)
+                labels.append(class_label)
+    return image_paths, labels
+
+
+def load_image(image_path, size):
+    """
+    Decodes a cell image and resizes it to size x size, exactly as training does.
+    :raise OSError: if the image is missing or cannot be decoded.
+    """
+    image=cv2.imread(image_path)
+    if image is None:
+        raise OSError("Cannot read image " + image_path)
+    return resize_image(image, size)
+
+
+def decode_image(data, size):
+    """
+    Decodes an encoded (e.g. png) cell image held in memory, with the preprocessing of load_image.
+    """
+    image=cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    return resize_image(image, size)
+
+
+def resize_image(image, size):
+    image=Image.fromarray(image,'RGB')
+    image=image.resize((size,size))
+    return np.array(image)
+
+
+def _load_image_star(arguments):
+    return load_image(*arguments)
+
+
+def _read_cache(cache_directory, size):
+    """
+    Opens a previously written dataset cache and returns a dictionary that maps every
+    cached image path to its mtime and row. Caches written for another SIZE are ignored.
+    """
+    if cache_directory is None or not os.path.exists(os.path.join(cache_directory, IMAGES_FILE)):
+        return None, {}
+    images, labels = open_dataset(cache_directory)
+    if images.shape[1] != size:
+        return None, {}
+    image_paths, mtimes = open_index(cache_directory)
+    return images, {str(path): (int(mtime), idx) for idx, (path, mtime) in enumerate(zip(image_paths, mtimes))}
+
+
+def load_dataset(image_directory, size, cache_directory=None, workers=None, chunksize=64):
+    """
+    Loads all cell images of image_directory resized to size x size. Decoding and
+    resizing run across a process pool and the result is kept as a memory-mapped
+    dataset in cache_directory (see malaria_dataset). The cache is keyed by image path,
+    mtime and size, so that only new or changed images are decoded again on the next run.
+    :param image_directory: the root directory containing 'Parasitized/' and 'Uninfected/'.
+    :param size: the width and height the images are resized to.
+    :param cache_directory: the dataset directory that holds the decoded images, None disables caching.
+    :param workers: the number of decoding processes, defaults to the number of cpus.
+    :param chunksize: the number of images sent to a worker at once.
+    :return: a uint8 array (memmap when cached) of N x size x size x 3 images and an array of N labels.
+    """
+    image_paths, labels = list_images(image_directory)
+    mtimes = [os.stat(image_path).st_mtime_ns for image_path in image_paths]
+    cached_images, cached = _read_cache(cache_directory, size)
+
+    # Rows of the cache that can be reused, in the order of the current listing
+    reused = []
+    to_decode = []
+    for idx, (image_path, mtime) in enumerate(zip(image_paths, mtimes)):
+        entry = cached.get(image_path)
+        if entry is not None and entry[0] == mtime:
+            reused.append((idx, entry[1]))
+        else:
+            to_decode.append(idx)
+
+    # Unchanged directory, the cache is the dataset
+    if cached_images is not None and not to_decode and len(cached) == len(image_paths) and \
+            all(idx == row for idx, row in reused):
+        print("Loaded {} images from cache.".format(len(image_paths)))
+        return cached_images, np.array(labels)
+
+    if cache_directory is None:
+        images = np.empty((len(image_paths), size, size, 3), dtype=np.uint8)
+    else:
+        new_directory = cache_directory + '.tmp'
+        shutil.rmtree(new_directory, ignore_errors=True)
+        images = create_dataset(new_directory, len(image_paths), size)
+
+    for idx, row in reused:
+        images[idx] = cached_images[row]
+
+    if to_decode:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            decoded = executor.map(_load_image_star, [(image_paths[idx], size) for idx in to_decode],
+                                   chunksize=chunksize)
+            for idx, image in zip(to_decode, decoded):
+                images[idx] = image
+
+    print("Loaded {} images, decoded {}.".format(len(image_paths), len(to_decode)))
+    if cache_directory is None:
+        return images, np.array(labels)
+
+    images.flush()
+    del images, cached_images
+    write_index(new_directory, labels, image_paths, mtimes)
+    replace_dataset(new_directory, cache_directory)
+    return open_dataset(cache_directory)
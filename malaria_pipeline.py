@@ -0,0 +1,69 @@
+import numpy as np
+import tensorflow as tf
+from malaria_loader import load_image
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+
+def file_pipeline(image_paths, targets, size, batch_size=64, shuffle=False, shuffle_buffer=None):
+    """
+    Streams cell images straight from their png files. Decoding and resizing run on
+    parallel tf.data calls with the preprocessing of malaria_loader.load_image, and
+    batches are prefetched while the model works on the current step, so the images
+    never have to fit in memory.
+    :param image_paths: the paths of the images, e.g. from malaria_loader.list_images.
+    :param targets: the one-hot targets of the images.
+    :param size: the width and height the images are resized to.
+    :param batch_size: the number of images per batch.
+    :param shuffle: reshuffles the images every epoch.
+    :param shuffle_buffer: the shuffle buffer size, defaults to all images. The buffer
+    only holds paths, since the images are decoded after shuffling.
+    :return: a tf.data.Dataset of (images, targets) batches.
+    """
+    targets = np.asarray(targets, dtype=np.float32)
+    dataset = tf.data.Dataset.from_tensor_slices((np.asarray(image_paths), targets))
+    if shuffle:
+        dataset = dataset.shuffle(shuffle_buffer or len(image_paths), reshuffle_each_iteration=True)
+
+    def decode(image_path, target):
+        image = tf.numpy_function(lambda path: load_image(path.decode(), size), [image_path], tf.uint8)
+        image.set_shape((size, size, 3))
+        return image, target
+
+    dataset = dataset.map(decode, num_parallel_calls=AUTOTUNE)
+    return dataset.batch(batch_size).prefetch(AUTOTUNE)
+
+
+def cached_pipeline(images, targets, indices, batch_size=64, shuffle=False, shuffle_buffer=None):
+    """
+    Streams batches of the rows indices of a memory-mapped dataset (see malaria_dataset).
+    Rows are gathered one batch at a time on parallel tf.data calls and prefetched.
+    :param images: the uint8 N x SIZE x SIZE x 3 image memmap.
+    :param targets: the one-hot targets of all N images.
+    :param indices: the rows of the split to stream.
+    :param batch_size: the number of images per batch.
+    :param shuffle: reshuffles the rows every epoch.
+    :param shuffle_buffer: the shuffle buffer size, defaults to all rows. The buffer only
+    holds row indices.
+    :return: a tf.data.Dataset of (images, targets) batches.
+    """
+    targets = np.asarray(targets, dtype=np.float32)
+    indices = np.asarray(indices, dtype=np.int64)
+    image_shape = images.shape[1:]
+    dataset = tf.data.Dataset.from_tensor_slices(indices)
+    if shuffle:
+        dataset = dataset.shuffle(shuffle_buffer or len(indices), reshuffle_each_iteration=True)
+
+    def gather(batch):
+        # Sorted rows read the memmap sequentially
+        batch = np.sort(batch)
+        return np.asarray(images[batch]), targets[batch]
+
+    def gather_batch(batch):
+        batch_images, batch_targets = tf.numpy_function(gather, [batch], [tf.uint8, tf.float32])
+        batch_images.set_shape((None,) + tuple(image_shape))
+        batch_targets.set_shape((None, targets.shape[1]))
+        return batch_images, batch_targets
+
+    dataset = dataset.batch(batch_size).map(gather_batch, num_parallel_calls=AUTOTUNE)
+    return dataset.prefetch(AUTOTUNE)
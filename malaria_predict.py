@@ -0,0 +1,192 @@
+#
+# Scores cell images with the trained malaria CNN (malaria_cnn.h5) and writes the
+# per-image probabilities to a CSV or Parquet file. Images that cannot be read are
+# not scored: their probabilities are NaN and the error column says why.
+#
+
+import os, sys, getopt
+import csv
+import time
+import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from malaria_export import load_inference_model
+from malaria_loader import load_image
+
+SIZE=64
+CLASS_NAMES = ['Parasitized', 'Uninfected']
+
+
+def list_input_images(inputs):
+    """
+    Collects the images to score. Every input is either a directory, which is searched
+    recursively for png files, or a text file with one image path per line.
+    :param inputs: a list of directories and file lists.
+    :return: a sorted list of image paths per input, concatenated.
+    """
+    image_paths = []
+    for input_path in inputs:
+        if os.path.isdir(input_path):
+            found = []
+            for (dirpath, dirnames, filenames) in os.walk(input_path):
+                for filename in filenames:
+                    if filename.lower().endswith('.png'):
+                        found.append(os.path.join(dirpath, filename))
+            image_paths.extend(sorted(found))
+        else:
+            with open(input_path) as f:
+                image_paths.extend(line.strip() for line in f if line.strip())
+    return image_paths
+
+
+def load_batch(image_paths, size):
+    """
+    Decodes a batch of images with the training preprocessing.
+    :return: a uint8 array of len(image_paths) x size x size x 3, black for unreadable images,
+    and a list with the error of every image, empty if it was read.
+    """
+    images = np.zeros((len(image_paths), size, size, 3), dtype=np.uint8)
+    errors = [''] * len(image_paths)
+    for idx, image_path in enumerate(image_paths):
+        try:
+            images[idx] = load_image(image_path, size)
+        except OSError as e:
+            errors[idx] = str(e)
+    return images, errors
+
+
+def iterate_batches(image_paths, size, batch_size, executor, prefetch=4):
+    """
+    Yields (paths, images, errors) batches, see load_batch. Up to prefetch batches are decoded by the executor
+    while the caller runs the model on the current one.
+    """
+    pending = deque()
+    for start in range(0, len(image_paths), batch_size):
+        batch_paths = image_paths[start:start + batch_size]
+        pending.append((batch_paths, executor.submit(load_batch, batch_paths, size)))
+        if len(pending) > prefetch:
+            batch_paths, future = pending.popleft()
+            yield (batch_paths,) + future.result()
+    while pending:
+        batch_paths, future = pending.popleft()
+        yield (batch_paths,) + future.result()
+
+
+def predict_images(model, image_paths, size=SIZE, batch_size=512, workers=None, prefetch=4):
+    """
+    Scores images in large batches, decoding the next batches in a process pool while
+    the model predicts the current one. Every batch is decoded by one worker, so at least
+    as many batches as workers are kept in flight.
+    :param model: a loaded keras model, or any object with predict_on_batch.
+    :param image_paths: the images to score.
+    :return: an array of N x 2 probabilities, NaN for unreadable images, a list of per-batch predict
+    latencies in seconds, and a list with the error of every image, empty if it was scored.
+    """
+    probabilities = np.empty((len(image_paths), len(CLASS_NAMES)), dtype=np.float32)
+    latencies = []
+    errors = []
+    position = 0
+    prefetch = max(prefetch, workers or os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for batch_paths, images, batch_errors in iterate_batches(image_paths, size, batch_size, executor, prefetch):
+            start = time.perf_counter()
+            probabilities[position:position + len(batch_paths)] = model.predict_on_batch(images)
+            latencies.append(time.perf_counter() - start)
+            # Unreadable images were scored as black placeholders
+            unreadable = [position + idx for idx, error in enumerate(batch_errors) if error]
+            probabilities[unreadable] = np.nan
+            errors.extend(batch_errors)
+            position += len(batch_paths)
+    return probabilities, latencies, errors
+
+
+def write_predictions(output_file, image_paths, probabilities, errors=None):
+    """
+    Writes one row per image with the probability of every class, the predicted class and the
+    error, empty for scored images. Unreadable images have NaN probabilities and no predicted class.
+    Files ending in .parquet are written with pyarrow, everything else as CSV.
+    """
+    if errors is None:
+        errors = [''] * len(image_paths)
+    columns = ['p_' + class_name.lower() for class_name in CLASS_NAMES]
+    predicted = [CLASS_NAMES[idx] if not error else '' for idx, error in zip(np.argmax(probabilities, axis=1), errors)]
+
+    if output_file.endswith('.parquet'):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = {'path': list(image_paths)}
+        for idx, column in enumerate(columns):
+            table[column] = probabilities[:, idx]
+        table['prediction'] = predicted
+        table['error'] = list(errors)
+        pq.write_table(pa.table(table), output_file)
+        return
+
+    with open(output_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['path'] + columns + ['prediction', 'error'])
+        for image_path, row, prediction, error in zip(image_paths, probabilities, predicted, errors):
+            writer.writerow([image_path] + ['{:.6f}'.format(value) for value in row] + [prediction, error])
+
+
+def report_throughput(num_images, elapsed, latencies):
+    latencies = np.asarray(latencies) * 1000
+    print("Scored {} images in {:.2f} s ({:.1f} images/sec).".format(num_images, elapsed, num_images / elapsed))
+    if len(latencies):
+        print("Batch latency p50 = {:.1f} ms, p99 = {:.1f} ms over {} batches.".format(
+            np.percentile(latencies, 50), np.percentile(latencies, 99), len(latencies)))
+
+
+def help():
+    print("malaria_predict.py -i <imagedirectory|filelist> [-i ...] -o <output.csv|output.parquet> "
+          "[-m <model.h5|model.tflite>] [-b <batchsize>] [-w <workers>]")
+
+
+if __name__ == "__main__":
+
+    inputs = []
+    output_file = 'predictions.csv'
+    model_file = 'malaria_cnn.h5'
+    batch_size = 512
+    workers = None
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hi:o:m:b:w:",
+                                   ["input=", "output=", "model=", "batchsize=", "workers="])
+    except getopt.GetoptError:
+        help()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            help()
+            sys.exit()
+        elif opt in ("-i", "--input"):
+            inputs.append(arg)
+        elif opt in ("-o", "--output"):
+            output_file = arg
+        elif opt in ("-m", "--model"):
+            model_file = arg
+        elif opt in ("-b", "--batchsize"):
+            batch_size = int(arg)
+        elif opt in ("-w", "--workers"):
+            workers = int(arg)
+
+    if not inputs:
+        help()
+        sys.exit(2)
+
+    # .tflite models run without keras, see malaria_export
+    model = load_inference_model(model_file)
+    # Preprocess with the input size the model was trained with
+    size = model.input_shape[1]
+
+    image_paths = list_input_images(inputs)
+    start = time.perf_counter()
+    probabilities, latencies, errors = predict_images(model, image_paths, size, batch_size, workers)
+    elapsed = time.perf_counter() - start
+
+    write_predictions(output_file, image_paths, probabilities, errors)
+    report_throughput(len(image_paths), elapsed, latencies)
+    unreadable = sum(1 for error in errors if error)
+    if unreadable:
+        print("Could not read {} images, see the error column.".format(unreadable))
+    print("Predictions saved at " + output_file)
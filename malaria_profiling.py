@@ -0,0 +1,176 @@
+#
+# Instrumentation for the malaria.py stages. StageProfiler times named stages and
+# samples the memory high-water mark while they run, TelemetryCallback records the
+# step time, throughput and data-wait vs compute time of every training batch, with
+# the data wait timed by a stage at the end of the tf.data input pipeline.
+# Both write into one trace in the Chrome trace event format, which can be opened
+# in chrome://tracing or Perfetto.
+#
+
+import os, sys
+import json
+import resource
+import threading
+import time
+from contextlib import contextmanager
+import tensorflow as tf
+from keras.callbacks import Callback
+
+
+def current_rss():
+    """
+    :return: the resident set size of this process in bytes.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # Not Linux, fall back to the high-water mark (kilobytes on Linux, bytes on macOS)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak * 1024 if sys.platform.startswith('linux') else peak
+
+
+class MemorySampler(threading.Thread):
+    """
+    Samples the resident set size every interval seconds and keeps its maximum.
+    """
+    def __init__(self, interval=0.05):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = current_rss()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.peak = max(self.peak, current_rss())
+        return self.peak
+
+
+class StageProfiler:
+    """
+    Records timed stages and instant counters as trace events.
+    """
+    def __init__(self, memory_interval=0.05):
+        self.memory_interval = memory_interval
+        self.origin = time.perf_counter()
+        self.events = []
+        self.stages = {}
+
+    def _timestamp(self, seconds=None):
+        # Trace timestamps are microseconds since the profiler was created
+        return ((time.perf_counter() if seconds is None else seconds) - self.origin) * 1e6
+
+    @contextmanager
+    def stage(self, name, **args):
+        """
+        Times the enclosed block and samples its memory high-water mark.
+        """
+        sampler = MemorySampler(self.memory_interval)
+        sampler.start()
+        rss_before = current_rss()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            peak = sampler.stop()
+            stage = {'seconds': seconds, 'rss_before_mb': rss_before / 2 ** 20, 'rss_peak_mb': peak / 2 ** 20}
+            self.stages[name] = stage
+            args.update(stage)
+            self.add_event(name, start, seconds, category='stage', args=args)
+
+    def add_event(self, name, start, seconds, category='stage', args=None, thread=0):
+        """
+        Adds a complete event that started at perf_counter() value start and lasted seconds.
+        """
+        self.events.append({'name': name, 'cat': category, 'ph': 'X', 'ts': self._timestamp(start),
+                            'dur': seconds * 1e6, 'pid': os.getpid(), 'tid': thread, 'args': args or {}})
+
+    def add_counter(self, name, values):
+        self.events.append({'name': name, 'ph': 'C', 'ts': self._timestamp(), 'pid': os.getpid(), 'args': values})
+
+    def summary(self):
+        for name, stage in self.stages.items():
+            print("{:<24s} {:9.2f} s  peak RSS {:8.1f} MB".format(name, stage['seconds'], stage['rss_peak_mb']))
+
+    def save(self, trace_file):
+        with open(trace_file, 'w') as f:
+            json.dump({'traceEvents': self.events, 'stages': self.stages}, f)
+        print("Trace saved at " + trace_file)
+
+
+class TelemetryCallback(Callback):
+    """
+    Records every training batch into profiler. Keras pulls the next batch from the input
+    pipeline inside the training step, between on_train_batch_begin and on_train_batch_end,
+    so the data wait is timed by the pipeline itself: instrument(dataset) appends a stage that
+    records when a batch leaves the pipeline. The time from the begin of a batch until its data
+    arrived is data wait, the rest of the step is compute. If data wait dominates, the input
+    is the bottleneck.
+
+        telemetry = TelemetryCallback(profiler, batch_size)
+        model.fit(telemetry.instrument(train_data), callbacks=[telemetry])
+    """
+    def __init__(self, profiler, batch_size):
+        super().__init__()
+        self.profiler = profiler
+        self.batch_size = batch_size
+        self.arrival = None
+        self.epoch_totals = None
+
+    def _record_arrival(self):
+        self.arrival = time.perf_counter()
+        return self.arrival
+
+    def _stamp(self, *batch):
+        arrival = tf.py_function(self._record_arrival, [], tf.float64)
+        with tf.control_dependencies([arrival]):
+            return tf.nest.map_structure(tf.identity, batch if len(batch) > 1 else batch[0])
+
+    def instrument(self, dataset):
+        """
+        :param dataset: the tf.data training pipeline, batched and prefetched.
+        :return: the pipeline with a last stage that records when every batch is handed to the
+        training step. It runs synchronously in the consumer, so no stage may be appended after it,
+        and the inject_prefetch optimization, which would prefetch past it, is disabled.
+        """
+        options = tf.data.Options()
+        options.experimental_optimization.inject_prefetch = False
+        return dataset.map(self._stamp).with_options(options)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+        self.epoch_totals = {'data_wait_seconds': 0.0, 'compute_seconds': 0.0, 'batches': 0}
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.arrival = None
+        self.batch_begin = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        batch_end = time.perf_counter()
+        step = batch_end - self.batch_begin
+        # Without instrument(), or if the batch was fetched before the step began, all of the step is compute
+        arrival = self.arrival if self.arrival is not None else self.batch_begin
+        data_wait = min(max(arrival - self.batch_begin, 0.0), step)
+        compute = step - data_wait
+        self.profiler.add_event('data_wait', self.batch_begin, data_wait, category='input', thread=1)
+        self.profiler.add_event('train_step', self.batch_begin + data_wait, compute, category='compute', thread=1,
+                                args={'epoch': self.epoch, 'batch': batch, 'step_seconds': step,
+                                      'samples_per_sec': self.batch_size / step if step > 0 else 0.0})
+        self.epoch_totals['data_wait_seconds'] += data_wait
+        self.epoch_totals['compute_seconds'] += compute
+        self.epoch_totals['batches'] += 1
+
+    def on_epoch_end(self, epoch, logs=None):
+        totals = dict(self.epoch_totals)
+        busy = totals['data_wait_seconds'] + totals['compute_seconds']
+        totals['data_wait_fraction'] = totals['data_wait_seconds'] / busy if busy > 0 else 0.0
+        totals['samples_per_sec'] = totals['batches'] * self.batch_size / busy if busy > 0 else 0.0
+        self.profiler.add_counter('epoch_{}'.format(epoch), totals)
+        print(" - data wait {:.0%} of step time, {:.1f} samples/sec".format(totals['data_wait_fraction'],
+                                                                              totals['samples_per_sec']))
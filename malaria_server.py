@@ -0,0 +1,214 @@
+#
+# Local HTTP service that keeps the malaria CNN loaded and scores single cell images.
+# Concurrent requests are collected into micro-batches before the model is called.
+#
+# POST /predict   body: an encoded (png) cell image, returns the class probabilities as JSON.
+# GET  /metrics   returns the queue depth and the batch size histogram as JSON.
+#
+
+import sys, getopt
+import json
+import queue
+import threading
+import time
+import urllib.request
+import numpy as np
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from malaria_export import load_inference_model
+from malaria_loader import decode_image
+
+CLASS_NAMES = ['Parasitized', 'Uninfected']
+
+
+class MicroBatcher:
+    """
+    Collects single images submitted from many threads into batches of at most
+    max_batch_size images. A batch is run as soon as it is full, or max_wait seconds
+    after its first image arrived, whichever comes first.
+    """
+    def __init__(self, predict, max_batch_size=64, max_wait=0.005):
+        """
+        :param predict: a function that maps a N x SIZE x SIZE x 3 array to N x 2 probabilities.
+        :param max_batch_size: the largest batch passed to predict.
+        :param max_wait: the longest time in seconds the first image of a batch waits for more images.
+        """
+        self.predict = predict
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.batch_size_histogram = np.zeros(max_batch_size + 1, dtype=np.int64)
+        self.lock = threading.Lock()
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, image):
+        """
+        Queues one image and returns a Future that resolves to its probabilities.
+        """
+        future = Future()
+        self.requests.put((image, future))
+        return future
+
+    def queue_depth(self):
+        return self.requests.qsize()
+
+    def metrics(self):
+        with self.lock:
+            histogram = self.batch_size_histogram.copy()
+        return {
+            'queue_depth': self.queue_depth(),
+            'batches': int(histogram.sum()),
+            'images': int(np.dot(histogram, np.arange(len(histogram)))),
+            'batch_size_histogram': {str(size): int(count) for size, count in enumerate(histogram) if count},
+        }
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+
+    def _collect(self):
+        # Block for the first image, then fill the batch until it is full or max_wait has passed
+        try:
+            batch = [self.requests.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while self.running:
+            batch = self._collect()
+            if not batch:
+                continue
+            images = np.stack([image for image, future in batch])
+            try:
+                probabilities = self.predict(images)
+            except Exception as e:
+                for image, future in batch:
+                    future.set_exception(e)
+                continue
+            with self.lock:
+                self.batch_size_histogram[len(batch)] += 1
+            for (image, future), row in zip(batch, probabilities):
+                future.set_result(row)
+
+
+class PredictionServer(ThreadingHTTPServer):
+    """
+    Threading HTTP server with a listen backlog large enough for bursts of concurrent
+    clients, the socketserver default of 5 resets their connections.
+    """
+    request_queue_size = 128
+
+
+def warm_up(model, size):
+    """
+    Runs the model once on a zero batch, so that the first client does not wait for the
+    graph to be traced.
+    """
+    model.predict_on_batch(np.zeros((1, size, size, 3), dtype=np.uint8))
+
+
+def create_server(batcher, size, host='127.0.0.1', port=8000):
+    """
+    Creates the HTTP server that decodes request images and hands them to batcher.
+    """
+    class PredictionHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != '/predict':
+                self.send_error(404)
+                return
+            data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            try:
+                image = decode_image(data, size)
+            except Exception:
+                self.send_error(400, "Could not decode image.")
+                return
+            probabilities = batcher.submit(image).result()
+            self._send_json({
+                'probabilities': {name: float(value) for name, value in zip(CLASS_NAMES, probabilities)},
+                'prediction': CLASS_NAMES[int(np.argmax(probabilities))],
+            })
+
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            self._send_json(batcher.metrics())
+
+        def _send_json(self, body):
+            body = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return PredictionServer((host, port), PredictionHandler)
+
+
+def predict_file(image_path, url='http://127.0.0.1:8000'):
+    """
+    Local client: sends one image file to a running server and returns its JSON answer.
+    """
+    with open(image_path, 'rb') as f:
+        request = urllib.request.Request(url + '/predict', data=f.read(), method='POST')
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def help():
+    print("malaria_server.py [-m <model.h5|model.tflite>] [-p <port>] [-b <maxbatchsize>] [-t <maxwaitms>]")
+
+
+if __name__ == "__main__":
+
+    model_file = 'malaria_cnn.h5'
+    port = 8000
+    max_batch_size = 64
+    max_wait = 0.005
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hm:p:b:t:", ["model=", "port=", "maxbatchsize=", "maxwaitms="])
+    except getopt.GetoptError:
+        help()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            help()
+            sys.exit()
+        elif opt in ("-m", "--model"):
+            model_file = arg
+        elif opt in ("-p", "--port"):
+            port = int(arg)
+        elif opt in ("-b", "--maxbatchsize"):
+            max_batch_size = int(arg)
+        elif opt in ("-t", "--maxwaitms"):
+            max_wait = float(arg) / 1000
+
+    # .tflite models run without keras, see malaria_export
+    model = load_inference_model(model_file)
+    size = model.input_shape[1]
+    warm_up(model, size)
+
+    batcher = MicroBatcher(model.predict_on_batch, max_batch_size, max_wait)
+    server = create_server(batcher, size, port=port)
+    print("Serving " + model_file + " on http://127.0.0.1:" + str(port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    batcher.close()
@@ -0,0 +1,203 @@
+#
+# Whole-slide scanning with the malaria CNN. A slide is a directory of thin-smear field
+# images. Every field is segmented into candidate cells tile by tile, the cells are
+# cropped and resized like the NIH training images (cell on black background), and the
+# crops are classified in batches to count parasitized cells and estimate parasitemia.
+# Fields that cannot be read are skipped and reported.
+#
+
+import os, sys, getopt
+import csv
+import numpy as np
+import cv2
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from malaria_export import load_inference_model
+from malaria_loader import resize_image
+
+FIELD_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp')
+
+
+def field_threshold(field, scale=4):
+    """
+    Otsu threshold that separates stained cells from the bright background, computed on a
+    downsampled copy of the whole field, so that tiles without cells are not split on noise.
+    """
+    gray = cv2.cvtColor(field[::scale, ::scale], cv2.COLOR_BGR2GRAY)
+    threshold, mask = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    return threshold
+
+
+def propose_cells(field, size, tile_size=1024, min_area=400, max_area=20000, max_cell_diameter=160):
+    """
+    Segments candidate cells in field tile by tile and yields one size x size crop per cell.
+    Tiles overlap by max_cell_diameter and a cell belongs to the tile whose core contains
+    its centroid, so cells on tile borders are counted exactly once.
+    :param field: a BGR field image as read by cv2.imread.
+    :param min_area: the smallest area in pixels of a cell.
+    :param max_area: the largest area in pixels of a single cell, larger blobs are clumps.
+    """
+    threshold = field_threshold(field)
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
+    height, width = field.shape[:2]
+    for top in range(0, height, tile_size):
+        for left in range(0, width, tile_size):
+            # The tile with its overlap
+            y0, x0 = max(0, top - max_cell_diameter), max(0, left - max_cell_diameter)
+            y1 = min(height, top + tile_size + max_cell_diameter)
+            x1 = min(width, left + tile_size + max_cell_diameter)
+            tile = field[y0:y1, x0:x1]
+
+            gray = cv2.cvtColor(tile, cv2.COLOR_BGR2GRAY)
+            mask = (gray <= threshold).astype(np.uint8)
+            mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
+            count, labels, stats, centroids = cv2.connectedComponentsWithStats(mask)
+            for component in range(1, count):
+                area = stats[component, cv2.CC_STAT_AREA]
+                cx, cy = centroids[component]
+                if area < min_area or area > max_area:
+                    continue
+                if not (top <= y0 + cy < top + tile_size and left <= x0 + cx < left + tile_size):
+                    continue
+
+                x, y = stats[component, cv2.CC_STAT_LEFT], stats[component, cv2.CC_STAT_TOP]
+                w, h = stats[component, cv2.CC_STAT_WIDTH], stats[component, cv2.CC_STAT_HEIGHT]
+                crop = tile[y:y + h, x:x + w].copy()
+                # Black background around the cell, like the NIH crops
+                crop[labels[y:y + h, x:x + w] != component] = 0
+                yield resize_image(crop, size)
+
+
+def field_crops(field_path, size, tile_size=1024):
+    """
+    Runs in a worker: reads one field and returns all of its cell crops.
+    :return: a uint8 array of N x size x size x 3, empty if the field cannot be read, and the
+    error of the field, None if it was read.
+    """
+    field = cv2.imread(field_path)
+    if field is None:
+        return np.zeros((0, size, size, 3), dtype=np.uint8), "Cannot read field " + field_path
+    crops = list(propose_cells(field, size, tile_size))
+    if not crops:
+        return np.zeros((0, size, size, 3), dtype=np.uint8), None
+    return np.stack(crops), None
+
+
+def iterate_fields(field_paths, size, executor, tile_size=1024, prefetch=4):
+    """
+    Yields the crops and the error of every field, see field_crops. At most prefetch fields are segmented ahead, so
+    memory does not grow with the number of fields of a slide.
+    """
+    pending = deque()
+    for field_path in field_paths:
+        pending.append(executor.submit(field_crops, field_path, size, tile_size))
+        if len(pending) > prefetch:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def scan_slide(model, field_paths, size, executor, batch_size=256, tile_size=1024, workers=None):
+    """
+    Classifies every cell of a slide in batches. Fields that cannot be read are skipped.
+    :param workers: the number of processes of executor, as many fields are segmented at once.
+    :return: the number of cells, the number of parasitized cells and the list of skipped fields.
+    """
+    cells = 0
+    parasitized = 0
+    batch = []
+    batched = 0
+    skipped = []
+
+    def classify(batch):
+        probabilities = model.predict_on_batch(np.concatenate(batch))
+        # Class 0 is Parasitized, see malaria_loader.CLASS_DIRECTORIES
+        return len(probabilities), int(np.sum(np.argmax(probabilities, axis=1) == 0))
+
+    prefetch = max(4, workers or os.cpu_count() or 1)
+    for field_path, (crops, error) in zip(field_paths, iterate_fields(field_paths, size, executor, tile_size,
+                                                                      prefetch)):
+        if error is not None:
+            print("Skipping field - " + error)
+            skipped.append(field_path)
+            continue
+        for start in range(0, len(crops), batch_size):
+            batch.append(crops[start:start + batch_size])
+            batched += len(batch[-1])
+            if batched >= batch_size:
+                counted, infected = classify(batch)
+                cells += counted
+                parasitized += infected
+                batch = []
+                batched = 0
+    if batch:
+        counted, infected = classify(batch)
+        cells += counted
+        parasitized += infected
+    return cells, parasitized, skipped
+
+
+def list_fields(slide_directory):
+    return sorted(os.path.join(slide_directory, filename) for filename in os.listdir(slide_directory)
+                  if filename.lower().endswith(FIELD_EXTENSIONS))
+
+
+def help():
+    print("malaria_slide.py -i <slidedirectory> [-i ...] [-o <parasitemia.csv>] [-m <model.h5|model.tflite>] "
+          "[-t <tilesize>] [-b <batchsize>] [-w <workers>]")
+
+
+if __name__ == "__main__":
+
+    slide_directories = []
+    output_file = 'parasitemia.csv'
+    model_file = 'malaria_cnn.h5'
+    tile_size = 1024
+    batch_size = 256
+    workers = None
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hi:o:m:t:b:w:",
+                                   ["input=", "output=", "model=", "tilesize=", "batchsize=", "workers="])
+    except getopt.GetoptError:
+        help()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            help()
+            sys.exit()
+        elif opt in ("-i", "--input"):
+            slide_directories.append(arg)
+        elif opt in ("-o", "--output"):
+            output_file = arg
+        elif opt in ("-m", "--model"):
+            model_file = arg
+        elif opt in ("-t", "--tilesize"):
+            tile_size = int(arg)
+        elif opt in ("-b", "--batchsize"):
+            batch_size = int(arg)
+        elif opt in ("-w", "--workers"):
+            workers = int(arg)
+
+    if not slide_directories:
+        help()
+        sys.exit(2)
+
+    model = load_inference_model(model_file)
+    size = model.input_shape[1]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor, open(output_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['slide', 'fields', 'skipped_fields', 'cells', 'parasitized', 'parasitemia'])
+        for slide_directory in slide_directories:
+            field_paths = list_fields(slide_directory)
+            cells, parasitized, skipped = scan_slide(model, field_paths, size, executor, batch_size, tile_size,
+                                                     workers)
+            parasitemia = parasitized / cells if cells else 0.0
+            writer.writerow([slide_directory, len(field_paths), len(skipped), cells, parasitized,
+                             '{:.6f}'.format(parasitemia)])
+            print("{}: {} cells, {} parasitized, parasitemia = {:.2%}".format(slide_directory, cells, parasitized,
+                                                                              parasitemia))
+            if skipped:
+                print("{}: skipped {} unreadable fields of {}".format(slide_directory, len(skipped),
+                                                                     len(field_paths)))
+    print("Parasitemia saved at " + output_file)
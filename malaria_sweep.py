@@ -0,0 +1,185 @@
+#
+# Hyper-parameter sweep of the malaria CNN over SIZE, batch size, dropout and filter
+# widths. The images are decoded once per SIZE into the memory-mapped cache, which all
+# worker processes share through the page cache. Configurations are pruned with
+# successive halving: every rung trains the surviving configurations for more epochs
+# in parallel, with early stopping and learning-rate reduction on plateaus, and only
+# the best 1/eta of them are promoted to the next rung.
+#
+
+import os, sys, getopt
+import itertools
+import json
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+SEARCH_SPACE = {
+    'size': [48, 64],
+    'batch_size': [32, 64, 128],
+    'dropout': [0.1, 0.2, 0.3],
+    'filters': [(16, 32, 64), (32, 64, 128)],
+}
+
+
+def expand_grid(search_space):
+    """
+    :return: the list of every combination of the values of search_space.
+    """
+    names = sorted(search_space)
+    return [dict(zip(names, values)) for values in itertools.product(*[search_space[name] for name in names])]
+
+
+def config_name(config):
+    return 'size{size}_batch{batch_size}_dropout{dropout}_filters{filters}'.format(
+        size=config['size'], batch_size=config['batch_size'], dropout=config['dropout'],
+        filters='-'.join(str(width) for width in config['filters']))
+
+
+def _limit_threads(threads):
+    # Runs in every worker before TensorFlow is imported there
+    os.environ['TF_NUM_INTRAOP_THREADS'] = str(threads)
+    os.environ['TF_NUM_INTEROP_THREADS'] = '1'
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+
+
+def train_config(config, cache_directory, sweep_directory, initial_epoch, epochs, patience):
+    """
+    Trains one configuration from initial_epoch to epochs in a worker process. The model
+    of the previous rung is resumed from sweep_directory, and saved there again.
+    :return: the config with its best validation accuracy, trained epochs and whether early stopping ended it.
+    """
+    import tensorflow as tf
+    from keras.callbacks import EarlyStopping, ReduceLROnPlateau
+    from keras.models import load_model
+    from keras.utils import to_categorical
+    from malaria import build_model
+    from malaria_dataset import open_dataset, split_indices
+    from malaria_pipeline import cached_pipeline
+
+    np.random.seed(1000)
+    tf.random.set_seed(1000)
+    x_images, label = open_dataset(cache_directory)
+    train_indices, test_indices = split_indices(len(label), test_size=0.20, random_state=0)
+    y_images = to_categorical(np.array(label))
+    train_data = cached_pipeline(x_images, y_images, train_indices, batch_size=config['batch_size'], shuffle=True)
+    test_data = cached_pipeline(x_images, y_images, test_indices, batch_size=config['batch_size'])
+
+    model_file = os.path.join(sweep_directory, config_name(config) + '.h5')
+    if initial_epoch > 0 and os.path.exists(model_file):
+        model = load_model(model_file)
+    else:
+        model = build_model(config['size'], dropout=config['dropout'], filters=config['filters'])
+        initial_epoch = 0
+
+    early_stopping = EarlyStopping(monitor='val_accuracy', patience=patience)
+    start = time.perf_counter()
+    history = model.fit(train_data, epochs=epochs, initial_epoch=initial_epoch, validation_data=test_data, verbose=0,
+                        callbacks=[early_stopping, ReduceLROnPlateau(monitor='val_loss', factor=0.5,
+                                                                     patience=max(1, patience // 2))])
+    model.save(model_file)
+
+    result = dict(config)
+    result['val_accuracy'] = float(max(history.history['val_accuracy']))
+    result['epochs'] = initial_epoch + len(history.history['val_accuracy'])
+    result['stopped_early'] = early_stopping.stopped_epoch > 0
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def run_sweep(image_directory, search_space, sweep_directory, min_epochs=2, max_epochs=25, eta=3, workers=None,
+              patience=3):
+    """
+    Runs successive halving over every configuration of search_space.
+    :param min_epochs: the epochs every configuration is trained for in the first rung.
+    :param max_epochs: the epochs of the last rung.
+    :param eta: the fraction 1/eta of the configurations promoted to the next rung, which
+    trains eta times more epochs.
+    :return: the results of every rung, best configuration first in the last rung.
+    """
+    from malaria_loader import load_dataset
+
+    if not os.path.exists(sweep_directory):
+        os.makedirs(sweep_directory)
+    workers = workers or max(1, (os.cpu_count() or 1) // 4)
+    threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+
+    # Decode the images once per SIZE, every worker only opens the memory-mapped cache
+    cache_directories = {}
+    for size in sorted(set(search_space['size'])):
+        cache_directories[size] = 'malaria_images_{}'.format(size)
+        load_dataset(image_directory, size, cache_directory=cache_directories[size])
+
+    candidates = expand_grid(search_space)
+    rungs = []
+    trained_epochs = 0
+    epochs = min_epochs
+    # Spawned workers do not inherit TensorFlow state from this process
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn'), initializer=_limit_threads,
+                             initargs=(threads_per_worker,)) as executor:
+        while candidates:
+            print("Rung {}: {} configurations for {} epochs.".format(len(rungs), len(candidates), epochs))
+            futures = [executor.submit(train_config, config, cache_directories[config['size']], sweep_directory,
+                                       trained_epochs, epochs, patience) for config in candidates]
+            results = sorted((future.result() for future in futures), key=lambda result: -result['val_accuracy'])
+            rungs.append(results)
+            for result in results:
+                print("  {:<48s} val_accuracy = {:.4f}".format(config_name(result), result['val_accuracy']))
+
+            if epochs >= max_epochs or len(results) == 1:
+                break
+            # Configurations that stopped early have plateaued and are not promoted
+            promoted = [result for result in results if not result['stopped_early']][:max(1, len(results) // eta)]
+            candidates = [{name: result[name] for name in search_space} for result in promoted]
+            trained_epochs = epochs
+            epochs = min(max_epochs, epochs * eta)
+
+    with open(os.path.join(sweep_directory, 'sweep_results.json'), 'w') as f:
+        json.dump(rungs, f, indent=2)
+    return rungs
+
+
+def help():
+    print("malaria_sweep.py [-i <imagedirectory>] [-d <sweepdirectory>] [-m <minepochs>] [-e <maxepochs>] "
+          "[-r <eta>] [-w <workers>] [-p <patience>]")
+
+
+if __name__ == "__main__":
+
+    image_directory = 'cell_images/cell_images_small/'
+    sweep_directory = 'malaria_sweep'
+    min_epochs = 2
+    max_epochs = 25
+    eta = 3
+    workers = None
+    patience = 3
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hi:d:m:e:r:w:p:",
+                                   ["imagedirectory=", "sweepdirectory=", "minepochs=", "maxepochs=", "eta=",
+                                    "workers=", "patience="])
+    except getopt.GetoptError:
+        help()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            help()
+            sys.exit()
+        elif opt in ("-i", "--imagedirectory"):
+            image_directory = arg
+        elif opt in ("-d", "--sweepdirectory"):
+            sweep_directory = arg
+        elif opt in ("-m", "--minepochs"):
+            min_epochs = int(arg)
+        elif opt in ("-e", "--maxepochs"):
+            max_epochs = int(arg)
+        elif opt in ("-r", "--eta"):
+            eta = int(arg)
+        elif opt in ("-w", "--workers"):
+            workers = int(arg)
+        elif opt in ("-p", "--patience"):
+            patience = int(arg)
+
+    rungs = run_sweep(image_directory, SEARCH_SPACE, sweep_directory, min_epochs, max_epochs, eta, workers, patience)
+    best = rungs[-1][0]
+    print("Best configuration: " + config_name(best) + " with val_accuracy = {:.4f}".format(best['val_accuracy']))